@@ -1,68 +1,293 @@
-import discord, os, subprocess
+import asyncio, discord, hashlib, json, logging, os, subprocess, sys, time
 from discord.errors import HTTPException
-from functools import wraps
 from importlib import import_module
-from typing import Any, Callable, Coroutine, Optional, TypeVar, cast
-from util.debug import DEBUG, DEBUG_GUILD, error, set_status
-from util.settings import Env
+from threading import Lock
+from typing import Any, Callable, Coroutine, Iterable, Optional, Tuple, TypeVar, cast
+from util.context import MessageContext
+from util.debug import DEBUG, DEBUG_GUILD, error, log, set_status
+from util.metrics import Counter, Gauge, Histogram
+from util.settings import Config, Env
 
 Coro = TypeVar('Coro', bound=Callable[..., Coroutine[Any, Any, Any]])
-class Bot(discord.Client):
-    '''Extends a client to provide support for multiple event handlers.'''
+AppCommand = discord.app_commands.Command[Any, ..., Any] | discord.app_commands.Group
 
+class Timing():
+    '''Tracks how long an event handler takes to run.'''
+    
+    calls: int
+    errors: int
+    total: float
+    slowest: float
+    
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.slowest = 0.0
+    
+    @property
+    def mean(self) -> float:
+        '''The average duration of a call in seconds.'''
+        
+        return self.total / self.calls if self.calls else 0.0
+    
+    def record(self, duration: float) -> None:
+        '''Records the duration of a call in seconds.'''
+        
+        self.calls += 1
+        self.total += duration
+        self.slowest = max(self.slowest, duration)
+
+class Bot(discord.AutoShardedClient):
+    '''Extends a sharded client to provide support for multiple concurrent event handlers.'''
+    
+    handlers: dict[str, list[Callable[..., Coroutine[Any, Any, Any]]]]
+    timings: dict[str, Timing]
+    _lock: Lock
+    
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.handlers = {}
+        self.timings = {}
+        self._lock = Lock()
+    
     def event(self, new: Coro, /) -> Coro:
         '''Registers a new event without obliterating the old one.'''
         
-        old: Optional[Coro] = getattr(self, new.__name__, None)
-
-        function: Coro = new
-        if old is not None:
-            # run both the old function and the new one
-            @wraps(new)
-            async def wrapper(*args: Any, **kwargs: Any) -> None:
-                await old(*args, **kwargs)
-                await new(*args, **kwargs)
-            function = cast(Coro, wrapper) # why do we have to cast?
+        # toes are set up in worker threads, so two of them may register the same event at once
+        name = new.__name__
+        with self._lock:
+            if name not in self.handlers:
+                self.handlers[name] = []
+                
+                # a single dispatcher per event runs every handler concurrently
+                async def dispatcher(*args: Any, **kwargs: Any) -> None:
+                    EVENTS.inc(name)
+                    
+                    # messages are examined once here, and handlers receive the results instead of the message
+                    if name == 'on_message':
+                        context = MessageContext(self, args[0])
+                        if context.ignored:
+                            return
+                        args = (context,)
+                    
+                    await asyncio.gather(*(self.run_handler(handler, *args, **kwargs) for handler in self.handlers[name]))
+                dispatcher.__name__ = name
+                super().event(dispatcher)
+            
+            self.handlers[name].append(new)
+            self.timings.setdefault(f'{new.__module__}.{name}', Timing())
+        return new
+    
+    async def run_handler(self, handler: Callable[..., Coroutine[Any, Any, Any]], *args: Any, **kwargs: Any) -> None:
+        '''Runs an event handler, timing it and keeping its errors from affecting the other handlers.'''
         
-        return super().event(function)
+        timing = self.timings[f'{handler.__module__}.{handler.__name__}']
+        start = time.perf_counter()
+        try:
+            await handler(*args, **kwargs)
+        except Exception as e:
+            timing.errors += 1
+            error(e, f'Bot :: Handler {handler.__module__}.{handler.__name__} failed!', toe=handler.__module__, latency=time.perf_counter() - start)
+        finally:
+            duration = time.perf_counter() - start
+            timing.record(duration)
+            HANDLER_SECONDS.observe(duration, f'{handler.__module__}.{handler.__name__}')
+
+EVENTS = Counter('kyoyobot_events_total', 'Gateway events dispatched to the toes, such as messages seen.', ['event'])
+HANDLER_SECONDS = Histogram('kyoyobot_handler_seconds', 'Time taken by each event handler.', ['handler'])
+COMMANDS = Counter('kyoyobot_commands_total', 'Slash commands completed successfully.', ['command'])
+
+def shard_settings() -> dict[str, Any]:
+    '''Reads the number of shards and which of them to run in this process from the environment, if specified.'''
+    
+    # without either, discord recommends a shard count and this process runs every shard
+    settings: dict[str, Any] = {}
+    if Env.get('SHARD_COUNT'):
+        settings['shard_count'] = int(str(Env.get('SHARD_COUNT')))
+    if Env.get('SHARD_IDS'):
+        settings['shard_ids'] = [int(id) for id in str(Env.get('SHARD_IDS')).split(',')]
+    
+    return settings
 
 # set up the discord client
 intents = discord.Intents().default()
 intents.messages = True
 intents.message_content = True
-bot = Bot(intents=intents)
+bot = Bot(intents=intents, **shard_settings())
 tree = discord.app_commands.CommandTree(bot)
+toes: list[str] = []
+
+LATENCY = Gauge('kyoyobot_gateway_latency_seconds', 'Latency between a gateway heartbeat and its acknowledgement.', lambda: bot.latency)
+
+SYNC_PATH = 'data/sync.jason'
+CONFIG_PATH = 'config.jason'
+watcher: Optional[asyncio.Task[None]] = None
+
+# set as soon as the toes start loading, and once they have finished
+loading = False
+ready = asyncio.Event()
+
+def command_hash(guild: Optional[discord.abc.Snowflake]) -> str:
+    '''Hashes the command tree exactly as it would be uploaded to discord.'''
+    
+    # toes load concurrently, so the commands are sorted to keep the hash independent of load order
+    payload = sorted((command.to_dict() for command in tree.get_commands(guild=guild)), key=lambda command: command['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf8')).hexdigest()
+
+async def sync_commands(guild: Optional[discord.abc.Snowflake]) -> None:
+    '''Uploads commands to discord, unless they are unchanged since the last successful upload.'''
+    
+    # when the shards are split between processes, only the one running the first shard uploads commands
+    if bot.shard_ids is not None and 0 not in bot.shard_ids:
+        return
+    
+    # the hash of the last upload is remembered separately for each application and guild
+    key = f'{bot.application_id}/{guild.id if guild else "global"}'
+    hashes: dict[str, str] = {}
+    try:
+        with open(SYNC_PATH, encoding='utf8') as file:
+            hashes = json.loads(file.read())
+    except (json.decoder.JSONDecodeError, FileNotFoundError):
+        pass
+    
+    hash = command_hash(guild)
+    if hashes.get(key) == hash and not Env.get('FORCE_SYNC'):
+        log('commands unchanged, skipping sync...')
+        return
+    
+    await tree.sync(guild=guild)
+    
+    hashes[key] = hash
+    with open(SYNC_PATH, 'w', encoding='utf8') as file:
+        file.write(json.dumps(hashes))
+
+def read_config() -> dict[str, Any]:
+    '''Reads the configuration file, raising an error if it is not a valid JSON object.'''
+    
+    with open(CONFIG_PATH, encoding='utf8') as file:
+        obj = json.loads(file.read())
+    
+    if not isinstance(obj, dict):
+        raise TypeError(f'{CONFIG_PATH} does not contain a JSON object!')
+    return cast(dict[str, Any], obj)
+
+def config_stamp() -> Optional[Tuple[int, int]]:
+    '''Returns the modification time and size of the configuration file, which change whenever it is saved.'''
+    
+    try:
+        stat = os.stat(CONFIG_PATH)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+async def reload_config(guild: Optional[discord.abc.Snowflake]) -> None:
+    '''Reloads the configuration and rebuilds every toe which supports it, without restarting the bot.'''
+    
+    # a file which fails to parse (say, because it is only half saved) leaves the old configuration in place
+    Config.replace(await asyncio.to_thread(read_config))
+    
+    # toes rebuild their state off the event loop and swap it in once it is complete
+    for toe in toes:
+        reload = getattr(sys.modules.get(f'toes.{toe}'), 'reload', None)
+        if reload is None:
+            continue
+        
+        try:
+            commands: Iterable[AppCommand] = await asyncio.to_thread(reload, bot)
+        except Exception as e:
+            error(e, f'Bot :: Failed to reload {toe} toe!', toe=toe)
+            continue
+        
+        for command in commands:
+            tree.add_command(command, guild=guild, override=True)
+    
+    # commands are only uploaded again if the reload actually changed them
+    await sync_commands(guild)
+    log('reloaded configuration...')
+
+async def watch_config(guild: Optional[discord.abc.Snowflake]) -> None:
+    '''Polls the configuration file, reloading it whenever it changes.'''
+    
+    stamp = config_stamp()
+    while True:
+        await asyncio.sleep(cast(float, Config.get('config_poll', 5)))
+        
+        latest = config_stamp()
+        if latest is None or latest == stamp:
+            continue
+        stamp = latest
+        
+        try:
+            await reload_config(guild)
+        except Exception as e:
+            error(e, 'Bot :: Failed to reload the configuration!')
 
 @bot.event
 async def on_ready() -> None:
     '''Initializes the bot.'''
     
+    # on_ready fires again whenever the gateway reconnects, but the toes only need to load once
+    # a reconnect while they are still loading leaves the status alone until they are done
+    global loading
+    if loading:
+        await ready.wait()
+        await set_status(bot, 'with feet')
+        return
+    loading = True
+    
     await set_status(bot, 'loading toes...')
     
     # if in debug mode, sync commands only to the test server
     guild = DEBUG_GUILD if DEBUG else None
     
-    # iterates over and loads every command group in the toes folder
-    toes = [toe.replace('.py', '') for toe in os.listdir('toes') if '.py' in toe]
-    for toe in toes:
-        print(f'loading {toe} toe...')
-        
+    # loads every command group in the toes folder concurrently, off the event loop
+    # each module returns a list of commands it creates, which are added as soon as it finishes
+    async def load_toe(toe: str) -> Tuple[str, Optional[Iterable[AppCommand]]]:
+        log(f'loading {toe} toe...', toe=toe)
         try:
-            # each module returns a list of commands it creates
-            module = import_module(f'toes.{toe}')
-            commands = module.setup(bot)
-            for command in commands:
-                tree.add_command(command, guild=guild)
+            module = await asyncio.to_thread(import_module, f'toes.{toe}')
+            return toe, await asyncio.to_thread(module.setup, bot)
         except Exception as e:
+            # a broken toe is left out, but the others still finish loading
+            error(e, f'Bot :: Failed to load {toe} toe!', toe=toe)
             await set_status(bot, f'failed to load {toe} toe!')
-            raise e
+            return toe, None
+    
+    names = [toe.replace('.py', '') for toe in sorted(os.listdir('toes')) if '.py' in toe]
+    failed: list[str] = []
+    for loaded in asyncio.as_completed([load_toe(toe) for toe in names]):
+        toe, commands = await loaded
+        if commands is None:
+            failed.append(toe)
+            continue
+        
+        for command in commands:
+            tree.add_command(command, guild=guild)
+        
+        toes.append(toe)
+        await set_status(bot, f'loaded {len(toes)}/{len(names)} toes...')
+    
+    if failed:
+        log(f'Bot :: Loaded {len(toes)}/{len(names)} toes, without {", ".join(sorted(failed))}.', logging.WARNING, toes=sorted(failed))
     
     # uploads commands to discord
-    await tree.sync(guild=guild)
-
+    await sync_commands(guild)
+    
+    # picks up changes to the configuration from now on
+    global watcher
+    watcher = asyncio.create_task(watch_config(guild))
+    
     # notifies that the bot is ready
+    ready.set()
     await set_status(bot, 'with feet')
 
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command: discord.app_commands.Command[Any, ..., Any] | discord.app_commands.ContextMenu) -> None:
+    '''Counts the slash commands that have been used.'''
+    
+    COMMANDS.inc(command.qualified_name)
+
 def run() -> None:
     '''Runs this module.'''
     
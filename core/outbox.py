@@ -0,0 +1,232 @@
+import asyncio, time
+from collections import deque
+from discord import Emoji, Message
+from discord.abc import Messageable
+from typing import Any, Optional, Tuple, cast
+
+from util.debug import error
+from util.metrics import Counter, Histogram
+from util.settings import Config
+
+# Every message and reaction the bot sends goes through the outbox, which
+# paces them to stay under discord's rate limits instead of running into 429s.
+# Each channel has a lane for texts and a lane for reactions, each drained by
+# its own worker as fast as the token buckets for the channel and its guild
+# allow, so that one kind never waits on the other's rate limit. High priority
+# actions go ahead of any low priority ones still waiting. Trigger responses
+# are low priority: under backpressure they are merged together, dropped when
+# the lane is full, and dropped if they wait too long.
+
+MESSAGE_LIMIT = 2000
+HIGH = 1
+LOW = 0
+
+ACTIONS = Counter('kyoyobot_actions_total', 'Messages and reactions sent, merged, dropped or failed by the outbox.', ['action', 'result'])
+DELAY_SECONDS = Histogram('kyoyobot_outbox_delay_seconds', 'Time each action waited in the outbox before being sent.', ['action'])
+
+class TokenBucket():
+    '''Allows a steady rate of actions, with bursts up to its capacity.'''
+    
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def delay(self, now: float) -> float:
+        '''Returns how many seconds remain until the next action is allowed.'''
+        
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    @property
+    def full(self) -> bool:
+        '''Whether the bucket would be full by now, meaning it has no effect and can be forgotten.'''
+        
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class Action():
+    '''A message or reaction waiting to be sent.'''
+    
+    kind: str
+    priority: int
+    text: str
+    emoji: Optional[str | Emoji]
+    target: Any
+    queued: float
+    result: 'asyncio.Future[str]'
+    
+    def __init__(self, kind: str, priority: int, target: Any, text: str = '', emoji: Optional[str | Emoji] = None):
+        self.kind = kind
+        self.priority = priority
+        self.target = target
+        self.text = text
+        self.emoji = emoji
+        self.queued = time.monotonic()
+        self.result = asyncio.get_running_loop().create_future()
+    
+    async def perform(self) -> None:
+        '''Sends the message or adds the reaction.'''
+        
+        if self.kind == 'text':
+            await cast(Messageable, self.target).send(self.text)
+        elif self.emoji is not None:
+            await cast(Message, self.target).add_reaction(self.emoji)
+
+class Lane():
+    '''The actions of one kind waiting to be sent in a channel, high priority first and otherwise in order.'''
+    
+    high: deque[Action]
+    low: deque[Action]
+    worker: Optional['asyncio.Task[None]']
+    
+    def __init__(self):
+        self.high = deque()
+        self.low = deque()
+        self.worker = None
+    
+    def __len__(self) -> int:
+        return len(self.high) + len(self.low)
+    
+    def peek(self) -> Action:
+        '''Returns the action which will be sent next.'''
+        
+        return self.high[0] if self.high else self.low[0]
+    
+    def pop(self) -> Action:
+        '''Removes the action which will be sent next.'''
+        
+        return self.high.popleft() if self.high else self.low.popleft()
+
+class Outbox():
+    '''Schedules outgoing messages and reactions within per-channel and per-guild rate limits.'''
+    
+    _lanes: dict[Tuple[int, str], Lane]
+    _buckets: dict[Tuple[str, int], TokenBucket]
+    _sending: set['asyncio.Task[None]']
+    
+    def __init__(self):
+        self._lanes = {}
+        self._buckets = {}
+        self._sending = set()
+    
+    def send(self, channel: Messageable, text: str, priority: int = HIGH) -> 'asyncio.Future[str]':
+        '''Queues a message for the channel, returning a future which resolves to what became of it.'''
+        
+        lane = self._lane(channel, 'text')
+        
+        # low priority messages are tacked onto one which is still waiting, if they fit
+        if priority == LOW and lane.low:
+            last = lane.low[-1]
+            if len(last.text) + len(text) < MESSAGE_LIMIT:
+                last.text += '\n' + text
+                ACTIONS.inc('text', 'merged')
+                return last.result
+        
+        return self._enqueue(channel, lane, Action('text', priority, channel, text=text))
+    
+    def react(self, message: Message, emoji: str | Emoji, priority: int = HIGH) -> 'asyncio.Future[str]':
+        '''Queues a reaction to the message, returning a future which resolves to what became of it.'''
+        
+        lane = self._lane(message.channel, 'reaction')
+        return self._enqueue(message.channel, lane, Action('reaction', priority, message, emoji=emoji))
+    
+    def _lane(self, channel: Any, kind: str) -> Lane:
+        '''Returns the lane of actions of the specified kind waiting to be sent in the channel.'''
+        
+        return self._lanes.setdefault((getattr(channel, 'id', 0), kind), Lane())
+    
+    def _enqueue(self, channel: Any, lane: Lane, action: Action) -> 'asyncio.Future[str]':
+        '''Adds an action to its lane, unless it is low priority and the lane is full.'''
+        
+        if action.priority == LOW and len(lane) >= cast(int, Config.get('outbox_queue', 10)):
+            self._finish(action, 'dropped')
+            return action.result
+        
+        (lane.high if action.priority == HIGH else lane.low).append(action)
+        if lane.worker is None or lane.worker.done():
+            guild = getattr(getattr(channel, 'guild', None), 'id', None)
+            lane.worker = asyncio.create_task(self._drain((getattr(channel, 'id', 0), action.kind), guild))
+        
+        return action.result
+    
+    def _bucket(self, kind: str, id: int) -> TokenBucket:
+        '''Returns the token bucket limiting the specified kind of action in a channel or guild.'''
+        
+        bucket = self._buckets.get((kind, id))
+        if bucket is None:
+            # buckets which have refilled completely are the same as new ones, so they are forgotten
+            if len(self._buckets) > 1024:
+                self._buckets = {key: bucket for key, bucket in self._buckets.items() if not bucket.full}
+            
+            rate = cast(float, Config.get(f'outbox_{kind}_rate', {'text': 0.6, 'reaction': 4.0, 'guild': 5.0}[kind]))
+            burst = cast(float, Config.get(f'outbox_{kind}_burst', {'text': 2.0, 'reaction': 1.0, 'guild': 10.0}[kind]))
+            bucket = self._buckets[(kind, id)] = TokenBucket(rate, burst)
+        
+        return bucket
+    
+    async def _drain(self, key: Tuple[int, str], guild: Optional[int]) -> None:
+        '''Sends the actions in a lane, waiting whenever a rate limit is reached.'''
+        
+        id, kind = key
+        lane = self._lanes[key]
+        while lane:
+            action = lane.peek()
+            now = time.monotonic()
+            
+            # low priority actions which have gone stale are no longer worth sending
+            if action.priority == LOW and now - action.queued > cast(float, Config.get('outbox_stale', 10)):
+                lane.pop()
+                self._finish(action, 'dropped')
+                continue
+            
+            buckets = [self._bucket(kind, id)]
+            if guild is not None:
+                buckets.append(self._bucket('guild', guild))
+            
+            # whatever is first after the wait is sent, in case something more important arrived
+            delay = max(bucket.delay(now) for bucket in buckets)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            
+            for bucket in buckets:
+                bucket.tokens -= 1
+            lane.pop()
+            DELAY_SECONDS.observe(now - action.queued, action.kind)
+            
+            # texts are sent one at a time to keep them in order, but reactions
+            # within the rate limit are added concurrently, in whatever order they land
+            if kind == 'text':
+                await self._perform(action)
+            else:
+                task = asyncio.create_task(self._perform(action))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+        
+        del self._lanes[key]
+    
+    async def _perform(self, action: Action) -> None:
+        '''Sends an action, recording whether it succeeded.'''
+        
+        try:
+            await action.perform()
+            self._finish(action, 'sent')
+        except Exception as e:
+            self._finish(action, 'failed')
+            error(e, f'Outbox :: Failed to send {action.kind}!', channel=getattr(action.target, 'id', None), latency=time.monotonic() - action.queued)
+    
+    def _finish(self, action: Action, result: str) -> None:
+        '''Records what became of an action.'''
+        
+        ACTIONS.inc(action.kind, result)
+        if not action.result.done():
+            action.result.set_result(result)
+
+outbox = Outbox()
@@ -1,8 +1,16 @@
+import math
+from aiohttp import web
 from flask import Flask
 from flask.typing import ResponseReturnValue
 from threading import Thread
+from typing import Any, Optional
+
+import core.bot as core
+from util.metrics import render
 from util.settings import Env
 
+METRICS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
 app: Flask = Flask('Kyoyobot')
 
 @app.route('/')
@@ -11,15 +19,63 @@ def route_index() -> ResponseReturnValue:
     
     return '🐛'
 
+@app.route('/metrics')
+def route_metrics() -> ResponseReturnValue:
+    '''Exposes the bot's metrics in the Prometheus text format.'''
+    
+    return render(), 200, {'Content-Type': METRICS_TYPE}
+
 def launch_server() -> None:
     '''Starts a server to receive pings that keep the application awake.'''
     
-    app.run(host='0.0.0.0', port=8080)
+    app.run(host='0.0.0.0', port=int(str(Env.get('PORT', 8080))))
+
+# the asynchronous server runs on the bot's own event loop, so its handlers can read the bot's state directly
+routes = web.RouteTableDef()
+runner: Optional[web.AppRunner] = None
+
+@routes.get('/')
+async def handle_index(request: web.Request) -> web.Response:
+    '''Receives pings to keep the server running.'''
+    
+    return web.Response(text='🐛')
+
+@routes.get('/metrics')
+async def handle_metrics(request: web.Request) -> web.Response:
+    '''Exposes the bot's metrics in the Prometheus text format.'''
+    
+    return web.Response(body=render().encode('utf8'), headers={'Content-Type': METRICS_TYPE})
+
+@routes.get('/status')
+async def handle_status(request: web.Request) -> web.Response:
+    '''Reports the live state of the bot.'''
+    
+    latency = core.bot.latency
+    status: dict[str, Any] = {
+        'ready': core.bot.is_ready(),
+        'latency': None if math.isnan(latency) or math.isinf(latency) else latency,
+        'guilds': len(core.bot.guilds),
+        'toes': sorted(core.toes),
+    }
+    return web.json_response(status)
+
+async def setup_hook() -> None:
+    '''Starts the asynchronous server once the bot's event loop is running, before it connects to discord.'''
+    
+    global runner
+    application = web.Application()
+    application.add_routes(routes)
+    runner = web.AppRunner(application)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', int(str(Env.get('PORT', 8080)))).start()
 
 def run() -> None:
     '''Runs this module.'''
     
     # imagine paying for server hosting 🐛
-    if Env.get('HOST') == 'R':
-        server = Thread(target=launch_server)
-        server.start()
+    server = Env.get('WEB_SERVER', 'flask' if Env.get('HOST') == 'R' else None)
+    if server == 'flask':
+        thread = Thread(target=launch_server)
+        thread.start()
+    elif server == 'aiohttp':
+        core.bot.event(setup_hook)
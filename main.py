@@ -1,5 +1,46 @@
-import core.bot as bot
-import core.web as web
+import multiprocessing
+from typing import Optional
 
-web.run()
-bot.run()
+from util.debug import error
+from util.settings import Env
+
+def launch(shard_ids: Optional[list[int]] = None, shard_count: Optional[int] = None) -> None:
+    '''Runs the bot in this process, limited to the specified shards if any.'''
+    
+    # the shards must be chosen before the bot is created, which happens when it is imported
+    if shard_ids is not None:
+        settings = {key: Env[key] for key in Env.keys()}
+        Env.replace({**settings, 'SHARD_IDS': ','.join(map(str, shard_ids)), 'SHARD_COUNT': str(shard_count)})
+    
+    import core.bot as bot
+    import core.web as web
+    
+    # the processes would all share the web server's port, so only the first one runs it
+    if shard_ids is None or 0 in shard_ids:
+        web.run()
+    bot.run()
+
+def launch_processes(processes: int) -> None:
+    '''Splits the shards between the specified number of processes, which each run their own bot.'''
+    
+    # the shards are dealt out in turn so that every process gets a similar share
+    count = int(str(Env.get('SHARD_COUNT', processes)))
+    workers = [
+        multiprocessing.Process(target=launch, args=([shard for shard in range(count) if shard % processes == index], count))
+        for index in range(processes)
+    ]
+    
+    for worker in workers:
+        worker.start()
+    
+    for index, worker in enumerate(workers):
+        worker.join()
+        if worker.exitcode:
+            error(RuntimeError(f'exit code {worker.exitcode}'), f'Main :: Shard process {index} stopped unexpectedly!')
+
+if __name__ == '__main__':
+    processes = int(str(Env.get('SHARD_PROCESSES', 1)))
+    if processes > 1:
+        launch_processes(processes)
+    else:
+        launch()
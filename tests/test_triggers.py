@@ -0,0 +1,68 @@
+import re, pytest
+from typing import Any, cast
+
+from toes.triggers import compile_keyword, create_choices
+from util.settings import Config
+
+# patterns whose matching time grows exponentially or as a high power of the message length
+BACKTRACKING = [
+    r'(a|aa)+$',
+    r'(?:a|aa)+$',
+    r'(a|a)*$',
+    r'(a+)+$',
+    r'(\w+\s?)*$',
+    r'(x+x+)+y',
+    r'(.*a){3}x',
+    r'(a?){25}a{25}',
+    r'a?' * 12 + 'a' * 12,
+    r'(a|b|ab)*c',
+    r'.*a.*b.*c',
+    r'(?:.{0,2000})(?:.{0,2000})z',
+    r'\w+\s{0,3}[ab]*z',
+    r'x*?(?:x+a|b+\s){2}',
+]
+
+# patterns like the ones in the configuration, which match quickly on any message
+SAFE = [
+    r'\?$',
+    r'\b(slovak(ia(n)?)?|svk)\b|🇸🇰',
+    r'^i$|^i-$',
+    r'^who.*\?$',
+    r'^(a.*b.*c)',
+    r'kyoyo|kyoyobot',
+    r'(ha)+',
+    r'(?:ab|cd)+',
+    r'\bno+\b',
+    r'\bbr+u+h+\b',
+    r'\d+\.\d+',
+    r'\bo+k+\b',
+    r'(yes|no|maybe)+',
+    r'(?=.*a)(?=.*b)',
+]
+
+@pytest.mark.parametrize('keyword', BACKTRACKING)
+def test_backtracking_refused(keyword: str) -> None:
+    with pytest.raises(re.error):
+        compile_keyword(keyword=keyword)
+    with pytest.raises(re.error):
+        compile_keyword(keyword=keyword, case_sensitive=True)
+
+@pytest.mark.parametrize('keyword', SAFE)
+def test_safe_compiled(keyword: str) -> None:
+    assert compile_keyword(keyword=keyword)['keyword'].pattern == keyword
+
+def test_configured_compiled() -> None:
+    # a refused keyword only shows up in the logs when the triggers are reloaded
+    triggers = cast(list[dict[str, Any]], Config.get('triggers'))
+    for trigger in triggers:
+        if 'keyword' in trigger:
+            compile_keyword(**trigger)
+
+def test_choices_prebuilt_for_one_argument() -> None:
+    prepared = create_choices(choices={'type': 'do_text do_react', 'text': ['a', 'b', 'c'], 'emoji': ['x']})
+    assert len(prepared['choices']) == 3 and not prepared['arguments']
+
+def test_choices_picked_for_several_arguments() -> None:
+    # every combination would be built otherwise, so each value is picked when the message arrives
+    prepared = create_choices(choices={'type': 'do_text do_react', 'text': ['a', 'b'] * 50, 'emoji': ['x', 'y'] * 50})
+    assert not prepared['choices'] and prepared['arguments']['type'] == ['do_text do_react']
@@ -17,8 +17,8 @@ def add_link_command(group: slash.Group, name: str, url: str, description: str =
         async def _(interaction: Interaction) -> None:
             await interaction.response.send_message(str(url), ephemeral=True)
 
-def setup(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
-    '''Sets up this bot module.'''
+def reload(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
+    '''Builds the link commands from the current configuration.'''
     
     links = slash.Group(name='links', description='A quick reference of useful links.')
     
@@ -35,3 +35,9 @@ def setup(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
         add_link_command(links, name, url, description)
     
     return [links]
+
+def setup(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
+    '''Sets up this bot module.'''
+    
+    # the commands are rebuilt in the same way whenever the configuration changes
+    return reload(bot)
@@ -3,6 +3,8 @@ from discord import app_commands as slash, Client, Interaction, TextChannel
 from uwuipy import uwuipy
 from typing import Any, Iterable
 
+from core.outbox import outbox
+
 UWU = uwuipy()
 
 @slash.command()
@@ -63,7 +65,9 @@ async def say(interaction: Interaction, channel: TextChannel, message: str) -> N
     '''Instruct Kyoyobot to speak on your behalf.'''
     
     text = f'{interaction.user.mention} told me to say \"{message}\" in {channel.mention}\n'
-    await channel.send(message)
+    
+    # the message is queued so that it respects the channel's rate limits, and the interaction is answered right away
+    outbox.send(channel, message)
     await interaction.response.send_message(text)
 
 def setup(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
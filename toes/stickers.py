@@ -16,9 +16,9 @@ def add_sticker_command(group: slash.Group, name: str, url: str, description: st
         @group.command(name=name, description=description)
         async def _(interaction: Interaction) -> None:
             await interaction.response.send_message(str(url))
-    
-def setup(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
-    '''Sets up this bot module.'''
+
+def reload(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
+    '''Builds the sticker commands from the current configuration.'''
     
     stickers = slash.Group(name='stickers', description='Posts stickers from a preset collection.')
     
@@ -35,3 +35,9 @@ def setup(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
         add_sticker_command(stickers, name, url, description)
     
     return [stickers]
+
+def setup(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
+    '''Sets up this bot module.'''
+    
+    # the commands are rebuilt in the same way whenever the configuration changes
+    return reload(bot)
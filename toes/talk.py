@@ -1,83 +1,212 @@
-import os, random
-from discord import app_commands as slash, Client, Interaction, Message
+import asyncio, os, random, time
+from collections import OrderedDict, deque
+from discord import app_commands as slash, Client, Interaction
 from discord.errors import HTTPException
 from discord.app_commands.errors import CommandAlreadyRegistered
-from typing import Any, Callable, Iterable, Sequence, Tuple
+from threading import Lock
+from typing import Any, Callable, Iterable, Optional, cast
 
-from util.debug import DEBUG, DEBUG_GUILD, catch
-from util.settings import json_settings
+from core.outbox import outbox
+from util.chain import NONE, Chain, load
+from util.context import MessageContext
+from util.debug import catch, log
+from util.metrics import Histogram
+from util.settings import Config
 
 PATH = 'data/markov/'
 
-def get_markov(name: str) -> Callable[[], str]:
-    '''Builds a Markov chain using the specified user's messages.'''
+class ChainCache():
+    '''Loads Markov chains on first use and keeps the most recently used ones within a memory budget.'''
+    
+    _chains: OrderedDict[str, Chain]
+    _budget: int
+    _size: int
+    _lock: Lock
     
-    config = json_settings(f'data/markov/{name}.jason')
+    def __init__(self, budget: int):
+        self._chains = OrderedDict()
+        self._budget = budget
+        self._size = 0
+        self._lock = Lock()
     
-    # load the data from the markov chain data file
-    word_data: dict[str, Tuple[Sequence[str], Sequence[int]]] = {}
-    for word in config.keys():
-        data: dict[str, int] = config[word]
-        word_data[word] = (tuple(data.keys()), tuple(data.values()))
+    def get(self, name: str) -> Chain:
+        '''Returns the Markov chain with the specified name, loading it if necessary.'''
+        
+        # chains are loaded from worker threads, so only one may touch the cache at a time
+        with self._lock:
+            chain = self._chains.get(name)
+            if chain is not None:
+                self._chains.move_to_end(name)
+                return chain
+            
+            start = time.perf_counter()
+            chain = load(f'{PATH}{name}.jason', MARKOV_ORDER, MARKOV_BUDGET)
+            self._chains[name] = chain
+            self._size += chain.nbytes
+            log(f'Talk :: Loaded {name}\'s order {chain.order} Markov chain ({chain.nbytes} bytes)', chain=name, latency=time.perf_counter() - start)
+            
+            # evict the least recently used chains, but always keep the newest one
+            # evicted chains are unmapped once nothing is generating from them anymore
+            while self._size > self._budget and len(self._chains) > 1:
+                _, evicted = self._chains.popitem(last=False)
+                self._size -= evicted.nbytes
+            
+            return chain
     
-    def choose_word(word: str):
-        '''Chooses a random word to follow the provided word in the generated text.'''
+    def peek(self, name: str) -> Optional[Chain]:
+        '''Returns the Markov chain with the specified name if it is already loaded, without waiting for the lock.'''
         
-        words, counts = word_data[word]
-        return random.choices(words, weights=counts)[0]
+        return self._chains.get(name)
+
+class SentencePool():
+    '''Keeps sentences generated ahead of time in a worker thread so that replies never wait on a Markov chain.'''
+    
+    _markov: Callable[[], str]
+    _sentences: deque[str]
+    _size: int
+    _refill: Optional[asyncio.Task[None]]
+    
+    def __init__(self, markov: Callable[[], str], size: int):
+        self._markov = markov
+        self._sentences = deque()
+        self._size = size
+        self._refill = None
+    
+    async def pop(self) -> str:
+        '''Takes a sentence from the pool, generating one on the spot only if the pool is empty.'''
+        
+        if self._sentences:
+            sentence = self._sentences.popleft()
+        else:
+            sentence = await asyncio.to_thread(self._markov)
+        
+        # top the pool back up in the background, unless that is already happening
+        if self._refill is None or self._refill.done():
+            self._refill = asyncio.create_task(self.refill())
+        
+        return sentence
+    
+    async def refill(self) -> None:
+        '''Generates sentences in a worker thread until the pool is full.'''
+        
+        with catch(Exception, 'Talk :: Failed to refill sentence pool!'):
+            missing = self._size - len(self._sentences)
+            if missing > 0:
+                self._sentences.extend(await asyncio.to_thread(lambda: [self._markov() for _ in range(missing)]))
+
+MARKOV_ORDER = cast(int, Config.get('markov_order', 1))
+MARKOV_BUDGET = cast(int, Config.get('markov_budget', 0)) # in bytes per chain, or 0 to keep the budget each chain was compiled with
+CHAINS = ChainCache(cast(int, Config.get('markov_memory', 8 * 2**20)))
+POOLS: dict[str, SentencePool] = {}
+POOL_SIZE = cast(int, Config.get('markov_pool', 8))
+MAX_LENGTH = cast(int, Config.get('markov_length', 1000))
+SEED_WORDS = cast(int, Config.get('markov_seed_words', 8))
+RETRIES = 5
+
+GENERATION_SECONDS = Histogram('kyoyobot_markov_seconds', 'Time taken to generate a sentence, including retries and loading the chain.', ['chain'], (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5))
+
+def get_markov(name: str) -> Callable[[], str]:
+    '''Returns a generator for the specified user's Markov chain, which is loaded on first use.'''
     
     def markov() -> str:
         '''Generates a message using the Markov chain.'''
         
-        words: list[str] = []
-        word: str = choose_word('')
-        
-        # the empty string represents the start and end of the message
-        while word:
-            words.append(word)
-            word = choose_word(word)
+        start = time.perf_counter()
+        chain = CHAINS.get(name)
         
-        return ' '.join(words)
+        # random walks which run too long are retried, and eventually cut short at the last word which fits
+        try:
+            for _ in range(RETRIES):
+                sentence = chain.generate(MAX_LENGTH)
+                if sentence is not None:
+                    return sentence
+            return chain.generate(MAX_LENGTH, truncate=True) or ''
+        finally:
+            GENERATION_SECONDS.observe(time.perf_counter() - start, name)
     
     return markov
 
+def grow_reply(name: str, chain: Chain, words: Iterable[str]) -> Optional[str]:
+    '''Generates a message containing one of the words using the specified user's Markov chain, if it knows any.'''
+    
+    start = time.perf_counter()
+    
+    # words are tried in a random order until one is known, as written or else in lowercase,
+    # so that every known word is as likely to be chosen but a long message costs only a few lookups
+    try:
+        words = list(words)
+        tried = random.sample(words, min(len(words), SEED_WORDS))
+        word = next((form for seed in tried for form in dict.fromkeys((seed, seed.lower())) if chain.lookup(form) != NONE), None)
+        if word is None:
+            return None
+        
+        for _ in range(RETRIES):
+            sentence = chain.grow(word, MAX_LENGTH)
+            if sentence is not None:
+                return sentence
+        return None
+    finally:
+        GENERATION_SECONDS.observe(time.perf_counter() - start, name)
+
+def get_seeded(name: str) -> Callable[[Iterable[str]], Optional[str]]:
+    '''Returns a generator for the specified user's Markov chain which grows a message from one of the provided words, if it knows any.'''
+    
+    def seeded(words: Iterable[str]) -> Optional[str]:
+        '''Generates a message containing one of the words using the Markov chain, which is loaded on first use.'''
+        
+        return grow_reply(name, CHAINS.get(name), words)
+    
+    return seeded
+
+def get_pool(name: str) -> SentencePool:
+    '''Returns the pool of pre-generated sentences for the specified user's Markov chain.'''
+    
+    if name not in POOLS:
+        POOLS[name] = SentencePool(get_markov(name), POOL_SIZE)
+    return POOLS[name]
+
 def add_talk_command(group: slash.Group, name: str, description: str = '') -> None:
     '''Generates a talk commmand and adds it to the specified command group.'''
     
     description = str(description or f'Have a conversation with {name.capitalize()}.')
-    markov = get_markov(name)
+    pool = get_pool(name)
     
     # attempt to add the command
     with catch((HTTPException, TypeError, CommandAlreadyRegistered), f'Talk :: Failed to load {name}\'s Markov chain!'):
         @group.command(name=name, description=description)
         async def _(interaction: Interaction) -> None:
-            await interaction.response.send_message(f'{name.capitalize()}: {markov()}')
+            # loading and generation happen in a worker thread to keep the event loop responsive
+            await interaction.response.send_message(f'{name.capitalize()}: {await pool.pop()}')
 
 def setup(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
     '''Sets up this bot module.'''
     
     # respond to mentions with kyoyo's markov chain
-    markov = get_markov('kyoyo')
+    pool = get_pool('kyoyo')
+    seeded = get_seeded('kyoyo')
     
-    async def on_message(message: Message) -> None:
-        # ignore messages sent by the bot to prevent infinite loops
-        if message.author == bot.user:
-            return
-        
-        # if in debug mode, only respond in direct messages or the debug server
-        if DEBUG and not (message.guild is None or message.guild.id == DEBUG_GUILD.id):
-            return
-        
-        # respond to mentions with the markov chain
-        if bot.user is not None and bot.user.mentioned_in(message):
-            await message.channel.send(markov())
+    # messages which should be ignored are filtered out by the bot before they get here
+    async def on_message(context: MessageContext) -> None:
+        # respond to mentions with the markov chain, growing the reply from one of the message's words if possible
+        if context.mentioned:
+            words = [word for word in context.words if not word.startswith('<@')]
+            
+            # growing a reply from a chain which is already loaded is quicker than handing it to a worker thread
+            chain = CHAINS.peek('kyoyo')
+            if not words:
+                sentence = None
+            elif chain is not None:
+                sentence = grow_reply('kyoyo', chain, words)
+            else:
+                sentence = await asyncio.to_thread(seeded, words)
+            outbox.send(context.message.channel, sentence or await pool.pop())
     bot.event(on_message)
     
     # also add each available markov chain as a slash command
     talk = slash.Group(name='talk', description='Simulate conversations with people who don\'t want to talk to you.')
     
-    # load each markov chain from the data folder
-    for name in os.listdir(PATH):
+    # register each markov chain in the data folder, deferring loading until it is used
+    for name in sorted(os.listdir(PATH)):
         if name.endswith('.jason'):
             add_talk_command(talk, name[:-6])
     
@@ -1,125 +1,485 @@
-import random, re
-from discord import app_commands as slash, Client, Message
+import logging, random, re, time, warnings
+from discord import app_commands as slash, Client, Emoji, Message
 from functools import wraps
-from typing import Any, Awaitable, Callable, Coroutine, Iterable, Mapping, Optional, Sequence, cast
+from itertools import product
+from typing import Any, Awaitable, Callable, Coroutine, Iterable, Mapping, Optional, Sequence, Tuple, cast
 
-from util.debug import DEBUG, DEBUG_GUILD, catch, error
+from core.outbox import LOW, MESSAGE_LIMIT, outbox
+from util.context import MessageContext
+from util.debug import catch, error, log
+from util.metrics import Counter
 from util.settings import Config
 
-Trigger = Callable[[Client, Message], Coroutine[Any, Any, None]]
+with warnings.catch_warnings():
+    # the parser behind the re module is only public under its deprecated names
+    warnings.simplefilter('ignore', DeprecationWarning)
+    import sre_constants as sre, sre_parse
+
+Trigger = Callable[[Client, MessageContext, 'Response'], Coroutine[Any, Any, None]]
 TriggerFactory = Callable[..., Trigger]
 TriggerModifier = Callable[[Trigger], Trigger]
 TriggerModifierFactory = Callable[..., TriggerModifier]
 
-async def null_trigger(bot: Client, message: Message, /) -> None: ...
+MATCHES = Counter('kyoyobot_trigger_matches_total', 'Messages which each configured trigger responded to.', ['trigger'])
+
+class Response():
+    '''Collects the actions triggered by a message so that they can be performed together.'''
+    
+    texts: list[str]
+    reactions: list[str | Emoji]
+    
+    def __init__(self):
+        self.texts = []
+        self.reactions = []
+    
+    def send(self, message: Message) -> None:
+        '''Queues every collected action in the outbox, combining the texts into as few messages as possible.'''
+        
+        # texts are joined by line breaks, within discord's message length limit
+        batches: list[str] = []
+        for text in self.texts:
+            if batches and len(batches[-1]) + len(text) < MESSAGE_LIMIT:
+                batches[-1] += '\n' + text
+            else:
+                batches.append(text)
+        
+        # trigger responses are low priority, so the outbox may merge or drop them when the channel is busy
+        for batch in batches:
+            outbox.send(message.channel, batch, LOW)
+        for emoji in self.reactions:
+            outbox.react(message, emoji, LOW)
+
+async def null_trigger(bot: Client, context: MessageContext, response: Response, /) -> None: ...
+
+### PATTERNS ###
+
+# characters beyond ascii which stand in for the rest of unicode when comparing character classes
+SAMPLE = 'éßÀЖλ中٣\u00a0\u2028\u3000😀'
+
+def backtracking(pattern: str, flags: int = 0) -> Optional[str]:
+    '''Returns a description of the part of a pattern which can make matching take exponential or cubic time, or None if there is none.
+    
+    Anything repeated must have only one way to match any text, which holds if every choice inside it can be told
+    apart by the next character, and only two repetitions which can trade characters may follow one another.'''
+    
+    parsed = sre_parse.parse(pattern, flags)
+    flags = parsed.state.flags
+    repeats = (sre.MAX_REPEAT, sre.MIN_REPEAT)
+    singles = (sre.LITERAL, sre.NOT_LITERAL, sre.ANY, sre.IN)
+    categories = {sre.CATEGORY_DIGIT: r'\d', sre.CATEGORY_NOT_DIGIT: r'\D', sre.CATEGORY_SPACE: r'\s', sre.CATEGORY_NOT_SPACE: r'\S', sre.CATEGORY_WORD: r'\w', sre.CATEGORY_NOT_WORD: r'\W'}
+    
+    # character classes are compared on the characters the pattern mentions, along with a sample of the rest
+    mentioned: set[str] = set()
+    def mention(items: sre_parse.SubPattern) -> None:
+        '''Collects the characters which the parsed items match literally or bound a range with.'''
+        
+        for op, av in items:
+            if op in (sre.LITERAL, sre.NOT_LITERAL):
+                mentioned.add(chr(cast(int, av)))
+            elif op == sre.IN:
+                for code, value in cast(list[Tuple[Any, Any]], av):
+                    if code == sre.LITERAL:
+                        mentioned.add(chr(value))
+                    elif code == sre.RANGE:
+                        mentioned.update(chr(bound) for bound in cast(Tuple[int, int], value))
+            else:
+                for value in av if isinstance(av, (tuple, list)) else (av,):
+                    if isinstance(value, sre_parse.SubPattern):
+                        mention(value)
+                    elif isinstance(value, list):
+                        for branch in cast(list[Any], value):
+                            if isinstance(branch, sre_parse.SubPattern):
+                                mention(branch)
+    
+    mention(parsed)
+    mentioned.update(map(chr, range(128)), SAMPLE)
+    everything = frozenset(case for char in mentioned for case in (char, char.lower(), char.upper()) if len(case) == 1)
+    
+    classes: dict[Tuple[Any, Any], frozenset[str]] = {}
+    def single(op: Any, av: Any) -> frozenset[str]:
+        '''Returns the characters which a parsed item matching one character can match.'''
+        
+        key = (op, tuple(cast(list[Any], av)) if isinstance(av, list) else av)
+        if key not in classes:
+            classes[key] = matching(op, av)
+        return classes[key]
+    
+    def matching(op: Any, av: Any) -> frozenset[str]:
+        '''Works out the characters which a parsed item matching one character can match.'''
+        
+        if op == sre.ANY:
+            return everything if flags & re.DOTALL else everything - {'\n'}
+        
+        def test(char: str) -> bool:
+            '''Whether the item matches the character, ignoring the case flag.'''
+            
+            if op in (sre.LITERAL, sre.NOT_LITERAL):
+                return (char == chr(av)) != (op == sre.NOT_LITERAL)
+            
+            found = False
+            negated = False
+            for code, value in cast(list[Tuple[Any, Any]], av):
+                if code == sre.NEGATE:
+                    negated = True
+                elif code == sre.LITERAL:
+                    found = found or char == chr(value)
+                elif code == sre.RANGE:
+                    found = found or value[0] <= ord(char) <= value[1]
+                elif code == sre.CATEGORY:
+                    found = found or value not in categories or re.match(categories[value], char, flags & re.ASCII) is not None
+            return found != negated
+        
+        ignore_case = bool(flags & re.IGNORECASE)
+        return frozenset(char for char in everything if test(char) or ignore_case and (test(char.lower()) or test(char.upper())))
+    
+    def first(items: list[Tuple[Any, Any]]) -> Tuple[frozenset[str], bool]:
+        '''Returns the characters which can start a match of a sequence of parsed items, and whether it can match nothing.'''
+        
+        chars: frozenset[str] = frozenset()
+        for op, av in items:
+            if op in singles:
+                return chars | single(op, av), False
+            
+            start, empty = frozenset[str](), True
+            if op in repeats:
+                low, _, body = cast(Tuple[int, int, sre_parse.SubPattern], av)
+                start, empty = first(body.data)
+                empty = empty or low == 0
+            elif op == sre.SUBPATTERN:
+                start, empty = first(cast(Tuple[Any, ...], av)[-1].data)
+            elif op == sre.BRANCH:
+                starts = [first(branch.data) for branch in cast(Tuple[Any, list[sre_parse.SubPattern]], av)[1]]
+                start, empty = frozenset[str]().union(*(start for start, _ in starts)), any(empty for _, empty in starts)
+            elif op in (sre.GROUPREF, sre.GROUPREF_EXISTS):
+                start = everything
+            elif op not in (sre.AT, sre.ASSERT, sre.ASSERT_NOT):
+                # anything else, such as a possessive repetition, is assumed to be able to start with anything
+                inner = cast(Any, av[-1] if isinstance(av, tuple) else av)
+                start, empty = first(inner.data) if isinstance(inner, sre_parse.SubPattern) else (everything, True)
+            
+            chars |= start
+            if not empty:
+                return chars, False
+        
+        return chars, True
+    
+    def characters(items: sre_parse.SubPattern) -> frozenset[str]:
+        '''Returns every character which a match of the parsed items can contain.'''
+        
+        chars: frozenset[str] = frozenset()
+        for op, av in items:
+            if op in singles:
+                chars |= single(op, av)
+            elif op in (sre.GROUPREF, sre.GROUPREF_EXISTS):
+                return everything
+            elif op == sre.BRANCH:
+                for branch in cast(Tuple[Any, list[sre_parse.SubPattern]], av)[1]:
+                    chars |= characters(branch)
+            elif op not in (sre.AT, sre.ASSERT, sre.ASSERT_NOT):
+                av = av[-1] if isinstance(av, tuple) else av
+                chars |= characters(av) if isinstance(av, sre_parse.SubPattern) else everything
+        
+        return chars
+    
+    def ambiguous(items: sre_parse.SubPattern, follow: frozenset[str]) -> Optional[str]:
+        '''Checks that every choice in part of a repetition can be made by looking at the next character, given the characters which can follow it.'''
+        
+        for index, (op, av) in enumerate(items.data):
+            after, empty = first(items.data[index + 1:])
+            after = after | follow if empty else after
+            
+            found: Optional[str] = None
+            if op in repeats:
+                low, high, body = cast(Tuple[int, int, sre_parse.SubPattern], av)
+                start, empty = first(body.data)
+                if empty and high > 1:
+                    return 'a repetition of something which can match nothing'
+                if low != high and start & after:
+                    return 'a repetition which can divide the same text in more than one way'
+                found = ambiguous(body, start | after if high > 1 else after)
+            elif op == sre.SUBPATTERN:
+                found = ambiguous(cast(Tuple[Any, ...], av)[-1], after)
+            elif op == sre.BRANCH:
+                # alternatives which can start the same way give each repetition many ways to match,
+                # including those left empty once the parser factors out the start they share
+                seen: frozenset[str] = frozenset()
+                empties = 0
+                for alternative in cast(Tuple[Any, list[sre_parse.SubPattern]], av)[1]:
+                    start, empty = first(alternative.data)
+                    start = start | after if empty else start
+                    empties += empty
+                    if empties > 1 or start & seen:
+                        return 'a repetition of alternatives which can match the same text'
+                    seen |= start
+                    found = found or ambiguous(alternative, after)
+            elif op == sre.GROUPREF_EXISTS:
+                return 'a repetition of a conditional group'
+            
+            # lookarounds are matched on their own, and possessive repetitions and atomic groups never backtrack
+            if found is not None:
+                return found
+        
+        return None
+    
+    def check(items: sre_parse.SubPattern) -> Optional[str]:
+        '''Checks every repetition in a sequence of parsed items.'''
+        
+        for op, av in items:
+            found: Optional[str] = None
+            if op in repeats:
+                _, high, body = cast(Tuple[int, int, sre_parse.SubPattern], av)
+                if high > 1:
+                    start, empty = first(body.data)
+                    found = 'a repetition of something which can match nothing' if empty else ambiguous(body, start)
+                else:
+                    found = check(body)
+            elif op == sre.SUBPATTERN:
+                found = check(cast(Tuple[Any, ...], av)[-1])
+            elif op == sre.BRANCH:
+                for branch in cast(Tuple[Any, list[sre_parse.SubPattern]], av)[1]:
+                    found = found or check(branch)
+            elif op in (sre.ASSERT, sre.ASSERT_NOT):
+                found = check(cast(Tuple[int, sre_parse.SubPattern], av)[1])
+            elif op == sre.GROUPREF_EXISTS:
+                _, yes, no = cast(Tuple[int, sre_parse.SubPattern, Optional[sre_parse.SubPattern]], av)
+                found = check(yes) or (check(no) if no is not None else None)
+            
+            if found is not None:
+                return found
+        
+        return None
+    
+    def trading(items: sre_parse.SubPattern, run: Tuple[int, frozenset[str]]) -> Tuple[int, Tuple[int, frozenset[str]]]:
+        '''Returns the most repetitions which can trade characters with one another in a sequence of parsed items,
+        along with the run of them still going at its end, given the run going at its start.'''
+        
+        most = run[0]
+        for op, av in items:
+            if op in repeats:
+                low, high, body = cast(Tuple[int, int, sre_parse.SubPattern], av)
+                
+                # the body is walked once more for a repetition, since one pass can trade with the next
+                before = run
+                for _ in range(2 if high > 1 else 1):
+                    inner, run = trading(body, run)
+                    most = max(most, inner)
+                if low == 0:
+                    run = (max(run[0], before[0]), run[1] | before[1])
+                
+                # a repetition which can end in many places extends the run before it if they share characters,
+                # and the run carries on past one which can be skipped even if they share none
+                if low != high:
+                    chars = characters(body)
+                    if before[1] & chars:
+                        run = (max(run[0], before[0] + 1), run[1] | chars)
+                    else:
+                        run = (max(run[0], 1), run[1] | chars)
+            elif op in singles:
+                # text which the run could also have matched lets it shift, and anything else ends it
+                if not run[1] & single(op, av):
+                    run = (0, frozenset())
+            elif op == sre.SUBPATTERN:
+                inner, run = trading(cast(Tuple[Any, ...], av)[-1], run)
+                most = max(most, inner)
+            elif op == sre.BRANCH:
+                # only one alternative is taken at a time, so the worst one counts
+                outcomes = [trading(branch, run) for branch in cast(Tuple[Any, list[sre_parse.SubPattern]], av)[1]]
+                most = max(most, *(inner for inner, _ in outcomes))
+                run = (max(count for _, (count, _) in outcomes), frozenset[str]().union(*(chars for _, (_, chars) in outcomes)))
+            elif op in (sre.GROUPREF, sre.GROUPREF_EXISTS):
+                run = (run[0], everything)
+            
+            # lookarounds neither match text nor end the run, and are counted on their own
+            most = max(most, run[0])
+        
+        return most, run
+    
+    def lookarounds(items: sre_parse.SubPattern) -> list[sre_parse.SubPattern]:
+        '''Returns the bodies of every lookaround in the parsed items.'''
+        
+        found: list[sre_parse.SubPattern] = []
+        for op, av in items:
+            if op in (sre.ASSERT, sre.ASSERT_NOT):
+                body = cast(Tuple[int, sre_parse.SubPattern], av)[1]
+                found += [body, *lookarounds(body)]
+            elif op == sre.BRANCH:
+                for branch in cast(Tuple[Any, list[sre_parse.SubPattern]], av)[1]:
+                    found += lookarounds(branch)
+            elif op != sre.IN:
+                av = av[-1] if isinstance(av, tuple) else av
+                found += lookarounds(av) if isinstance(av, sre_parse.SubPattern) else []
+        
+        return found
+    
+    found = check(parsed)
+    if found is not None:
+        return found
+    
+    # each repetition which can end anywhere multiplies the work by the length of the message, and a
+    # search tries every starting position, so an unanchored pattern has one more in effect
+    anchored = bool(parsed.data) and parsed.data[0] in ((sre.AT, sre.AT_BEGINNING), (sre.AT, sre.AT_BEGINNING_STRING)) and not flags & re.MULTILINE
+    for items in (parsed, *lookarounds(parsed)):
+        if trading(items, (0, frozenset()))[0] + (items is not parsed or not anchored) >= 3:
+            return 'too many repetitions in sequence which can match the same text'
+    
+    return None
 
 ### MODIFIERS ###
 
 modifiers: dict[str, TriggerModifierFactory] = {}
+preparers: dict[str, Callable[..., dict[str, Any]]] = {}
 
 def modifier(func: Callable[..., Awaitable[None]]) -> TriggerModifierFactory:
     '''Converts a flat trigger modifier into a compositable decorator factory.'''
-
+    
     @wraps(func)
     def decorator_wrapper(**kwargs: Any) -> TriggerModifier:
         #a factory function which produces a decorator
+        prepare = preparers.get(func.__name__)
+        if prepare is not None:
+            #converts the arguments once, rather than on every message
+            kwargs = prepare(**kwargs)
+        
         def decorator(trigger: Trigger) -> Trigger:
             #a decorator function
             @wraps(trigger)
-            async def wrapper(bot: Client, message: Message) -> None:
+            async def wrapper(bot: Client, context: MessageContext, response: Response) -> None:
                 #a wrapper which passes in the environment to the original function
-                await func(bot, message, trigger, **kwargs)
+                await func(bot, context, response, trigger, **kwargs)
             return wrapper
         return decorator
-
+    
     # logs the modifier so that it is accessible from the jason file
     modifiers[func.__name__] = decorator_wrapper
     return decorator_wrapper
 
+def preparer(factory: TriggerModifierFactory) -> Callable[[Callable[..., dict[str, Any]]], Callable[..., dict[str, Any]]]:
+    '''Registers a function which converts a modifier's arguments when its trigger is created.'''
+    
+    def decorator(func: Callable[..., dict[str, Any]]) -> Callable[..., dict[str, Any]]:
+        preparers[factory.__name__] = func
+        return func
+    return decorator
+
 ###
 
 # IMPORTANT!
 # @modifier changes the function signature of each of the following functions
-# to call them, do NOT use `await`, and omit the first three arguments
+# to call them, do NOT use `await`, and omit the first four arguments
 
 @modifier
-async def if_keyword(bot: Client, message: Message, trigger: Trigger, *, keyword: str, case_sensitive: bool = False, **kwargs: Any) -> None:
+async def if_keyword(bot: Client, context: MessageContext, response: Response, trigger: Trigger, *, keyword: re.Pattern[str], length: int, **kwargs: Any) -> None:
     '''Executes the trigger only if the keyword is present in the message.'''
     
-    if re.search(keyword, message.content, re.IGNORECASE if not case_sensitive else 0):
-        await trigger(bot, message)
+    if keyword.search(context.content[:length]):
+        await trigger(bot, context, response)
+
+@preparer(if_keyword)
+def compile_keyword(*, keyword: str, case_sensitive: bool = False, **kwargs: Any) -> dict[str, Any]:
+    '''Compiles the keyword pattern ahead of time, refusing patterns which could take too long to match.'''
+    
+    flags = re.IGNORECASE if not case_sensitive else 0
+    problem = backtracking(keyword, flags)
+    if problem is not None:
+        raise re.error(f'{keyword} contains {problem}, which could block the bot on long messages')
+    
+    # only the start of very long messages is searched, which bounds the time any pattern can take
+    length = cast(int, Config.get('trigger_length', 2000))
+    return {**kwargs, 'keyword': re.compile(keyword, flags), 'length': length}
 
 @modifier
-async def if_author(bot: Client, message: Message, trigger: Trigger, *, author_id: int, **kwargs: Any) -> None:
+async def if_author(bot: Client, context: MessageContext, response: Response, trigger: Trigger, *, author_id: int, **kwargs: Any) -> None:
     '''Executes the trigger only if the provided ID matches the message author.'''
     
-    if message.author.id == author_id:
-        await trigger(bot, message)
+    if context.message.author.id == author_id:
+        await trigger(bot, context, response)
 
 @modifier
-async def if_lucky(bot: Client, message: Message, trigger: Trigger, *, probability: float, **kwargs: Any) -> None:
+async def if_lucky(bot: Client, context: MessageContext, response: Response, trigger: Trigger, *, probability: float, **kwargs: Any) -> None:
     '''Executes the trigger with a random probability.'''
     
     if random.random() * 100 <= probability:
-        await trigger(bot, message)
+        await trigger(bot, context, response)
 
 ###
 
 @modifier
-async def do_text(bot: Client, message: Message, trigger: Trigger, *, text: str, **kwargs: Any) -> None:
+async def do_text(bot: Client, context: MessageContext, response: Response, trigger: Trigger, *, text: str, **kwargs: Any) -> None:
     '''Sends a text response in the channel in which the message was received.'''
     
-    with catch(Exception, 'Triggers :: Failed to send message!'):
-        await message.channel.send(text)
+    response.texts.append(text)
     
-    await trigger(bot, message)
+    await trigger(bot, context, response)
 
 @modifier
-async def do_react(bot: Client, message: Message, trigger: Trigger, *, emoji: str, **kwargs: Any) -> None:
+async def do_react(bot: Client, context: MessageContext, response: Response, trigger: Trigger, *, emoji: str, **kwargs: Any) -> None:
     '''Reacts to the message with a standard emoji.'''
     
-    with catch(Exception, f'Triggers :: Failed to add standard emoji reaction "{emoji}"!'):
-        await message.add_reaction(emoji)
+    response.reactions.append(emoji)
     
-    await trigger(bot, message)
+    await trigger(bot, context, response)
 
 @modifier
-async def do_react_custom(bot: Client, message: Message, trigger: Trigger, *, emoji_id: int, **kwargs: Any) -> None:
+async def do_react_custom(bot: Client, context: MessageContext, response: Response, trigger: Trigger, *, emoji_id: int, **kwargs: Any) -> None:
     '''Reacts to the message with a custom emoji.'''
     
-    with catch(Exception, f'Triggers :: Failed to add custom emoji reaction "{emoji_id}"!'):
-        emoji = bot.get_emoji(emoji_id)
-        if emoji:
-            await message.add_reaction(emoji)
+    emoji = bot.get_emoji(emoji_id)
+    if emoji:
+        response.reactions.append(emoji)
     
-    await trigger(bot, message)
+    await trigger(bot, context, response)
 
 ###
 
 @modifier
-async def do_another(bot: Client, message: Message, trigger: Trigger, *, other: Mapping[str, Any], **kwargs: Any) -> None:
+async def do_another(bot: Client, context: MessageContext, response: Response, trigger: Trigger, *, other: Trigger, **kwargs: Any) -> None:
     '''Executes another trigger before this one.'''
     
-    other_trigger = create_trigger(**other)
-    if other_trigger is not None:
-        await other_trigger(bot, message)
-    await trigger(bot, message)
+    await other(bot, context, response)
+    await trigger(bot, context, response)
+
+@preparer(do_another)
+def create_other(*, other: Mapping[str, Any], **kwargs: Any) -> dict[str, Any]:
+    '''Creates the other trigger ahead of time.'''
+    
+    return {**kwargs, 'other': create_trigger(**other) or null_trigger}
 
 @modifier
-async def do_random(bot: Client, message: Message, trigger: Trigger, *, choices: Mapping[str, Sequence[Any]], **kwargs: Any):
+async def do_random(bot: Client, context: MessageContext, response: Response, trigger: Trigger, *, choices: Sequence[Trigger], arguments: Mapping[str, Sequence[Any]], **kwargs: Any):
     '''Executes another trigger with random arguments before this one.'''
     
-    with catch(Exception, f'Triggers :: Failed to execute random trigger!'):
-        other = {key: values if key == 'type' else random.choice(values) for key, values in choices.items()}
+    if choices:
+        await random.choice(choices)(bot, context, response)
+    elif arguments:
+        # when several arguments vary, a value is picked for each and the trigger is created for this message
+        other = create_trigger(**{key: random.choice(values) for key, values in arguments.items()})
+        if other is not None:
+            await other(bot, context, response)
+    await trigger(bot, context, response)
+
+@preparer(do_random)
+def create_choices(*, choices: Mapping[str, Sequence[Any]], **kwargs: Any) -> dict[str, Any]:
+    '''Creates a trigger for every value of the random argument ahead of time, if only one argument varies.'''
+    
+    keys = [key for key in choices if key != 'type']
+    if any(not choices[key] for key in keys):
+        return {**kwargs, 'choices': [], 'arguments': {}}
     
-    modified = add_trigger(trigger, other)
-    await modified(bot, message)
+    # every combination of several arguments could be far too many triggers to build
+    if sum(len(choices[key]) > 1 for key in keys) > 1:
+        return {**kwargs, 'choices': [], 'arguments': {**{key: choices[key] for key in keys}, 'type': [choices.get('type')]}}
+    
+    # with a single varying argument, there is one combination per value
+    triggers: list[Trigger] = []
+    for values in product(*(choices[key] for key in keys)):
+        other = create_trigger(**dict(zip(keys, values)), type=choices.get('type'))
+        if other is not None:
+            triggers.append(other)
+    
+    return {**kwargs, 'choices': triggers, 'arguments': {}}
 
 ### SETUP ###
 
-def add_trigger(trigger: Trigger, other: Mapping[str, Any]):
-    return do_another(other=other)(trigger)
-
 def create_trigger(**kwargs: Any) -> Optional[Trigger]:
     '''Creates a trigger by stacking the specified modifier types.'''
     
@@ -130,43 +490,246 @@ def create_trigger(**kwargs: Any) -> Optional[Trigger]:
         error(e, f'Triggers :: Failed to create trigger of unreadable type {types}.')
         return None
     
+    return stack_trigger(types, kwargs)
+
+def stack_trigger(types: Sequence[str], kwargs: Mapping[str, Any]) -> Optional[Trigger]:
+    '''Creates a trigger by stacking the modifiers with the specified types.'''
+    
     trigger = null_trigger
     for type in reversed(types):
         try:
             modifier_factory = modifiers[type]
             modifier = modifier_factory(**kwargs)
             trigger = modifier(trigger)
-        except IndexError as e:
-            error(e, f'Triggers :: Failed to create trigger of type {types} because of type "{type}".')
+        except (IndexError, KeyError, TypeError, re.error) as e:
+            error(e, f'Triggers :: Failed to create trigger of type {types} because of type "{type}".', trigger=' '.join(types))
             return None
     
     return trigger
 
-def setup(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
-    '''Sets up this bot module.'''
+class TriggerTable():
+    '''A flat table of triggers which dispatches each message after scanning it for keywords once.'''
     
-    trigger = null_trigger
+    _entries: list[Tuple[str, Optional[int], float, Trigger]]
+    _quiet: dict[Tuple[str, int], float]
+    _patterns: list[re.Pattern[str]]
+    _lowered: list[bool]
+    _scans: list[Tuple[re.Pattern[str], bool, list[int]]]
+    _unscanned: list[int]
+    _length: int
+    _slow: float
+    _budget: float
+    _strikes: int
+    _timings: list[Tuple[int, float, int]]
+    _tripped: set[int]
+    
+    def __init__(self, configs: Iterable[Mapping[str, Any]]):
+        self._entries = []
+        self._quiet = {}
+        self._patterns = []
+        self._lowered = []
+        ids: dict[Tuple[str, int], int] = {}
+        
+        # matching stops once a message has taken up its budget, and patterns which are
+        # repeatedly slow on their own are tripped until the triggers are next reloaded
+        # a single search cannot be interrupted, so it is compile_keyword refusing patterns which
+        # backtrack that keeps any one search down to at worst quadratic time in the message length
+        self._length = cast(int, Config.get('trigger_length', 2000))
+        self._slow = cast(float, Config.get('trigger_slow', 0.02))
+        self._budget = cast(float, Config.get('trigger_budget', 0.05))
+        self._strikes = cast(int, Config.get('trigger_strikes', 3))
+        self._tripped = set()
+        
+        for index, config in enumerate(configs):
+            types = config.get('type', '')
+            try:
+                types = types.split()
+            except AttributeError as e:
+                error(e, f'Triggers :: Failed to create trigger of unreadable type {types}.')
+                continue
+            
+            # a leading keyword check is pulled out of the stack so that it can be indexed
+            id: Optional[int] = None
+            if types and types[0] == 'if_keyword':
+                try:
+                    pattern: re.Pattern[str] = compile_keyword(**config)['keyword']
+                except (KeyError, TypeError, re.error) as e:
+                    error(e, f'Triggers :: Failed to compile keyword for trigger of type {types}.', trigger=index)
+                    continue
+                
+                id = ids.setdefault((pattern.pattern, pattern.flags), len(ids))
+                if id == len(self._patterns):
+                    # case-insensitive patterns without capitals match the lowercase content exactly,
+                    # which is cheaper than matching the original content while ignoring case
+                    lowered = bool(pattern.flags & re.IGNORECASE) and pattern.pattern == pattern.pattern.lower()
+                    if lowered:
+                        pattern = re.compile(pattern.pattern, pattern.flags & ~re.IGNORECASE)
+                    self._patterns.append(pattern)
+                    self._lowered.append(lowered)
+                types = types[1:]
+            
+            # a trigger with a cooldown stays quiet in a channel for that many seconds after responding there
+            try:
+                cooldown = float(config.get('cooldown', Config.get('trigger_cooldown', 0)))
+            except (TypeError, ValueError) as e:
+                error(e, f'Triggers :: Failed to read cooldown for trigger of type {types}.', trigger=index)
+                continue
+            
+            trigger = stack_trigger(types, config)
+            if trigger is not None:
+                self._entries.append((str(index), id, cooldown, trigger))
+        
+        # triggers run latest first, like the chain of modifiers they replace
+        self._entries.reverse()
+        
+        # patterns with the same flags are combined into one alternation which rules out most
+        # messages in a single scan, while references to numbered groups are checked separately
+        self._scans = []
+        self._unscanned = []
+        groups: dict[Tuple[int, bool], list[int]] = {}
+        for id, pattern in enumerate(self._patterns):
+            if re.search(r'\\[1-9]|\(\?P=|\(\?\(', pattern.pattern):
+                self._unscanned.append(id)
+            else:
+                groups.setdefault((pattern.flags, self._lowered[id]), []).append(id)
+        
+        for (flags, lowered), members in groups.items():
+            try:
+                scan = re.compile('|'.join(f'(?:{self._patterns[id].pattern})' for id in members), flags)
+                self._scans.append((scan, lowered, members))
+            except re.error:
+                self._unscanned.extend(members)
+        
+        # the searches, total seconds and slow searches of each pattern
+        self._timings = [(0, 0.0, 0) for _ in self._patterns]
+    
+    def timings(self) -> list[Tuple[str, int, float, int]]:
+        '''Returns each keyword pattern with how many times it has been searched for, the total seconds taken and how many searches were slow.'''
+        
+        return [(pattern.pattern, *timing) for pattern, timing in zip(self._patterns, self._timings)]
+    
+    def _search(self, id: int, text: str) -> bool:
+        '''Searches for a keyword pattern in the text, timing the search and tripping the pattern if it is repeatedly slow.'''
+        
+        if id in self._tripped:
+            return False
+        
+        start = time.perf_counter()
+        found = self._patterns[id].search(text) is not None
+        elapsed = time.perf_counter() - start
+        
+        searches, total, slow = self._timings[id]
+        searches, total = searches + 1, total + elapsed
+        if elapsed > self._slow:
+            slow += 1
+            log(f'Triggers :: Pattern {self._patterns[id].pattern!r} took {elapsed * 1000:.1f} ms on {len(text)} characters ({slow}/{self._strikes} strikes, {total / searches * 1000:.3f} ms on average).', logging.WARNING, trigger=self._patterns[id].pattern, latency=elapsed, length=len(text), strikes=slow)
+            if slow >= self._strikes:
+                self._tripped.add(id)
+                log(f'Triggers :: Pattern {self._patterns[id].pattern!r} is too slow, so it is disabled until the triggers are reloaded.', logging.WARNING, trigger=self._patterns[id].pattern)
+        self._timings[id] = (searches, total, slow)
+        
+        return found
+    
+    def match(self, context: MessageContext) -> set[int]:
+        '''Returns the ids of the keyword patterns present in the message, within the time budget.'''
+        
+        content = context.content[:self._length]
+        lowered = context.lowered[:self._length]
+        start = time.perf_counter()
+        
+        def spent() -> bool:
+            '''Whether the message has used up its time budget, in which case the remaining patterns are treated as absent.'''
+            
+            elapsed = time.perf_counter() - start
+            if elapsed > self._budget:
+                log(f'Triggers :: Matching a message of {len(content)} characters took {elapsed * 1000:.1f} ms, so the remaining patterns were skipped.', logging.WARNING, latency=elapsed, length=len(content))
+            return elapsed > self._budget
+        
+        matched: set[int] = set()
+        for id in self._unscanned:
+            if self._search(id, lowered if self._lowered[id] else content):
+                matched.add(id)
+            if spent():
+                return matched
+        
+        for scan, is_lowered, members in self._scans:
+            text = lowered if is_lowered else content
+            before = time.perf_counter()
+            found = scan.search(text)
+            elapsed = time.perf_counter() - before
+            
+            # a slow combined scan cannot say which pattern was to blame, so its patterns are searched separately from now on
+            if elapsed > self._slow:
+                self._scans = [entry for entry in self._scans if entry[2] is not members]
+                self._unscanned = self._unscanned + members
+                log(f'Triggers :: Scanning for {len(members)} patterns at once took {elapsed * 1000:.1f} ms, so they will be searched separately.', logging.WARNING, latency=elapsed, length=len(text))
+            
+            if found:
+                matched.update(id for id in members if self._search(id, text))
+            if spent():
+                return matched
+        
+        return matched
+    
+    def _cool(self, index: str, channel: int, until: float) -> None:
+        '''Keeps a trigger quiet in a channel until the specified time.'''
+        
+        # cooldowns which have run out are forgotten every so often
+        if len(self._quiet) > 4096:
+            now = time.monotonic()
+            self._quiet = {key: end for key, end in self._quiet.items() if end > now}
+        self._quiet[(index, channel)] = until
+    
+    async def __call__(self, bot: Client, context: MessageContext) -> None:
+        '''Executes every trigger whose keyword, if any, is present in the message.'''
+        
+        matched = self.match(context)
+        channel = getattr(context.message.channel, 'id', 0)
+        now = time.monotonic()
+        response = Response()
+        for index, id, cooldown, trigger in self._entries:
+            if id is not None and id not in matched:
+                continue
+            if cooldown and now < self._quiet.get((index, channel), 0.0):
+                continue
+            
+            # a trigger has responded if it queued up any actions
+            queued = len(response.texts) + len(response.reactions)
+            await trigger(bot, context, response)
+            if len(response.texts) + len(response.reactions) > queued:
+                MATCHES.inc(index)
+                if cooldown:
+                    self._cool(index, channel, now + cooldown)
+        
+        # the actions are only queued once every trigger has had its say
+        response.send(context.message)
+
+table = TriggerTable([])
+
+def reload(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
+    '''Compiles the triggers from the current configuration and swaps them in.'''
+    
+    global table
     
     # pulls trigger information from the configuration file
     trigger_config: list[dict[str, Any]] = []
     with catch(TypeError, 'Triggers :: Failed to load trigger configuration!'):
         trigger_config = cast(list[dict[str, Any]], Config.get('triggers'))
     
-    for trigger_info in trigger_config:
-        # combines the triggers
-        trigger = add_trigger(trigger, trigger_info)
+    # compiles the triggers into a single table, which replaces the old one all at once
+    table = TriggerTable(trigger_config)
     
-    async def on_message(message: Message) -> None:
-        # ignore messages sent by the bot to prevent infinite loops
-        if message.author == bot.user:
-            return
-        
-        # if in debug mode, only respond in direct messages or the debug server
-        if DEBUG and not (message.guild is None or message.guild.id == DEBUG_GUILD.id):
-            return
-        
-        # execute the master trigger
-        await trigger(bot, message)
+    return []
+
+def setup(bot: Client) -> Iterable[slash.Command[Any, ..., Any] | slash.Group]:
+    '''Sets up this bot module.'''
+    
+    reload(bot)
+    
+    # messages which should be ignored are filtered out by the bot before they get here
+    async def on_message(context: MessageContext) -> None:
+        # execute the matching triggers, using whichever table is current
+        await table(bot, context)
     bot.event(on_message)
     
     return []
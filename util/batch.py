@@ -0,0 +1,137 @@
+import numpy as np
+from numpy.typing import NDArray
+from typing import Optional
+
+from util.chain import NONE, Chain
+
+# This module is not for use with the bot, but rather as additional utility.
+# It requires NumPy, which is installed with the `batch` extra.
+
+class BatchChain():
+    '''A Markov chain stored as NumPy arrays, which advances many random walks at once.'''
+    
+    _start: int
+    _starts: NDArray[np.int64]
+    _degrees: NDArray[np.int64]
+    _targets: NDArray[np.int64]
+    _nexts: NDArray[np.int64]
+    _probabilities: NDArray[np.float64]
+    _aliases: NDArray[np.int64]
+    _lengths: NDArray[np.int64]
+    _words: list[str]
+    
+    def __init__(self, chain: Chain):
+        leaves, targets, weights, nexts = chain.arrays()
+        
+        # the edges of each leaf stay contiguous, as in the compiled chain
+        offsets = np.frombuffer(leaves, dtype=np.uint32).astype(np.int64)
+        self._start = chain.start
+        self._starts = offsets[:-1]
+        self._degrees = np.diff(offsets)
+        self._targets = np.frombuffer(targets, dtype=np.uint32).astype(np.int64)
+        self._nexts = np.frombuffer(nexts, dtype=np.uint32).astype(np.int64)
+        
+        # recover the raw counts from the cumulative weights
+        cumulative = np.frombuffer(weights, dtype=np.uint32).astype(np.int64)
+        counts = np.diff(cumulative, prepend=0)
+        counts[self._starts[self._degrees > 0]] = cumulative[self._starts[self._degrees > 0]]
+        self._probabilities, self._aliases = alias_tables(offsets, counts)
+        
+        # the vocabulary is decoded once, since batches touch most of it anyway
+        self._words = [chain.word(id) for id in range(chain.size)]
+        self._lengths = np.array([len(word) for word in self._words], dtype=np.int64)
+    
+    def step(self, states: NDArray[np.int64], rng: np.random.Generator) -> NDArray[np.int64]:
+        '''Chooses the next edge to follow from each of the provided leaves at once, or -1 for leaves without any.'''
+        
+        # pick a uniform edge, then keep it or take its alias as in Vose's alias method
+        degrees = self._degrees[states]
+        edges = self._starts[states] + (rng.random(len(states)) * degrees).astype(np.int64)
+        edges = np.minimum(edges, len(self._targets) - 1)
+        edges = np.where(rng.random(len(states)) < self._probabilities[edges], edges, self._aliases[edges])
+        
+        # leaves without successors end the message, just like in the compiled chain
+        return np.where(degrees > 0, edges, -1)
+    
+    def walk(self, count: int, limit: Optional[int], rng: np.random.Generator) -> list[list[int]]:
+        '''Performs random walks from the start of a message, returning the words of those within the limit.'''
+        
+        # a chain without a starting context can only ever produce empty messages
+        if self._start == NONE:
+            return [[] for _ in range(count)]
+        
+        active = np.arange(count)
+        states = np.full(count, self._start, dtype=np.int64)
+        lengths = np.full(count, -1, dtype=np.int64)
+        abandoned = np.zeros(count, dtype=np.bool_)
+        walkers: list[NDArray[np.int64]] = []
+        words: list[NDArray[np.int64]] = []
+        
+        while len(active):
+            edges = self.step(states, rng)
+            chosen = np.where(edges >= 0, self._targets[edges], 0)
+            lengths += self._lengths[chosen] + 1
+            
+            # word 0 represents the end of the message, and walks over the limit are abandoned
+            alive = chosen != 0
+            if limit is not None:
+                abandoned[active[alive & (lengths > limit)]] = True
+                alive &= lengths <= limit
+            
+            active, edges, chosen, lengths = active[alive], edges[alive], chosen[alive], lengths[alive]
+            walkers.append(active)
+            words.append(chosen)
+            
+            # walks which reach a context that never continues end there too
+            states = self._nexts[edges]
+            ongoing = states != NONE
+            active, states, lengths = active[ongoing], states[ongoing], lengths[ongoing]
+        
+        # regroup the words, which were recorded step by step, by walk
+        walker = np.concatenate(walkers)
+        order = np.argsort(walker, kind='stable')
+        ids: list[int] = np.concatenate(words)[order].tolist()
+        sizes = np.bincount(walker, minlength=count)
+        ends: list[int] = np.cumsum(sizes).tolist()
+        starts: list[int] = (np.cumsum(sizes) - sizes).tolist()
+        
+        return [ids[start:end] for start, end, lost in zip(starts, ends, abandoned.tolist()) if not lost]
+    
+    def generate(self, count: int, limit: Optional[int] = None, rng: Optional[np.random.Generator] = None) -> list[str]:
+        '''Generates the specified number of messages, each no longer than the limit in characters.
+        
+        Walks over the limit are discarded and replaced, just like retrying the scalar generator.'''
+        
+        rng = rng or np.random.default_rng()
+        messages: list[str] = []
+        while len(messages) < count:
+            for walk in self.walk(count - len(messages), limit, rng):
+                messages.append(' '.join([self._words[id] for id in walk]))
+        
+        return messages
+
+def alias_tables(offsets: NDArray[np.int64], counts: NDArray[np.int64]) -> tuple[NDArray[np.float64], NDArray[np.int64]]:
+    '''Builds an alias table over the edges of each state, so that sampling an edge takes constant time.'''
+    
+    probabilities = np.ones(len(counts), dtype=np.float64)
+    aliases = np.arange(len(counts), dtype=np.int64)
+    
+    for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        if end - start < 2:
+            continue
+        
+        # scale the weights so that the average edge has a weight of one
+        scaled = (counts[start:end] * (end - start) / counts[start:end].sum()).tolist()
+        small = [edge for edge, weight in enumerate(scaled) if weight < 1]
+        large = [edge for edge, weight in enumerate(scaled) if weight >= 1]
+        
+        # pair each light edge with a heavy edge which makes up the difference
+        while small and large:
+            light, heavy = small.pop(), large[-1]
+            probabilities[start + light] = scaled[light]
+            aliases[start + light] = start + heavy
+            scaled[heavy] -= 1 - scaled[light]
+            if scaled[heavy] < 1:
+                small.append(large.pop())
+    
+    return probabilities, aliases
@@ -0,0 +1,252 @@
+import asyncio, os, random, statistics, sys, time
+from discord import Client, Message
+from typing import Any, Callable, Coroutine, Iterable, Mapping, Tuple, cast
+
+import toes.talk as talk
+import toes.triggers as triggers
+from toes.talk import CHAINS, PATH, get_markov, get_seeded
+from toes.triggers import Response, create_trigger
+from util.chain import load
+from util.context import MessageContext
+from util.markov import dce_authored_messages
+from util.settings import Config
+
+# This module is not for use with the bot, but rather as additional utility.
+# Run it from the repository root with `python -m util.bench`, optionally
+# followed by DiscordChatExporter exports to replay instead of generated text.
+
+def bench_markov(name: str, seconds: float = 1.0) -> float:
+    '''Measures how many sentences per second the specified Markov chain generates.'''
+    
+    # load the chain first, so that compiling it on a fresh checkout is not timed
+    CHAINS.get(name)
+    markov = get_markov(name)
+    
+    # generate sentences until the time runs out
+    count = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end:
+        markov()
+        count += 1
+    
+    return count / (time.perf_counter() - start)
+
+def bench_seeded(name: str, seconds: float = 1.0) -> float:
+    '''Measures how many sentences per second the specified Markov chain grows from random words in its vocabulary.'''
+    
+    # the chain is loaded before the timer starts, as above
+    chain = CHAINS.get(name)
+    seeded = get_seeded(name)
+    words = [chain.word(id) for id in range(1, chain.size)]
+    
+    # grow sentences until the time runs out
+    count = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end and words:
+        seeded([random.choice(words)])
+        count += 1
+    
+    return count / (time.perf_counter() - start)
+
+def bench_load(name: str) -> float:
+    '''Measures how many seconds it takes to load the specified Markov chain, assuming it is already compiled.'''
+    
+    start = time.perf_counter()
+    load(f'{PATH}{name}.jason').close()
+    return time.perf_counter() - start
+
+def bench_batch(name: str, count: int = 100000) -> float:
+    '''Measures how many sentences per second the NumPy engine generates from the specified Markov chain.'''
+    
+    # imported here since the engine requires numpy, which is optional
+    from util.batch import BatchChain
+    
+    chain = BatchChain(load(f'{PATH}{name}.jason'))
+    start = time.perf_counter()
+    chain.generate(count)
+    return count / (time.perf_counter() - start)
+
+class StubUser():
+    '''Stands in for a Discord user.'''
+    
+    id: int
+    
+    def __init__(self, id: int = 0):
+        self.id = id
+    
+    def mentioned_in(self, message: 'StubMessage') -> bool:
+        return f'<@{self.id}>' in message.content
+
+class StubChannel():
+    '''Stands in for a Discord channel, discarding everything sent to it.'''
+    
+    async def send(self, content: str) -> None: ...
+
+class StubMessage():
+    '''Stands in for a Discord message.'''
+    
+    content: str
+    author: StubUser
+    channel: StubChannel
+    guild: None = None
+    
+    def __init__(self, content: str, author_id: int = 0):
+        self.content = content
+        self.author = StubUser(author_id)
+        self.channel = StubChannel()
+    
+    async def add_reaction(self, emoji: Any) -> None: ...
+
+class StubClient():
+    '''Stands in for a Discord client, collecting the event handlers registered with it.'''
+    
+    user: StubUser = StubUser(-1)
+    handlers: dict[str, list[Callable[..., Coroutine[Any, Any, Any]]]]
+    
+    def __init__(self):
+        self.handlers = {}
+    
+    def event(self, coro: Callable[..., Coroutine[Any, Any, Any]], /) -> Callable[..., Coroutine[Any, Any, Any]]:
+        self.handlers.setdefault(coro.__name__, []).append(coro)
+        return coro
+    
+    def get_emoji(self, id: int) -> Any:
+        return f'<:emoji:{id}>'
+
+def bench_trigger(config: Mapping[str, Any], seconds: float = 0.2) -> float:
+    '''Measures how many times per second the specified trigger fires on a message that satisfies it.'''
+    
+    # make every condition pass so that the whole trigger is exercised
+    trigger = create_trigger(**{**config, 'keyword': '', 'probability': 100})
+    if trigger is None:
+        return 0.0
+    bot = cast(Client, StubClient())
+    message = cast(Message, StubMessage('', int(config.get('author_id', 0))))
+    context = MessageContext(bot, message)
+    
+    async def run() -> float:
+        count = 0
+        start = time.perf_counter()
+        end = start + seconds
+        while time.perf_counter() < end:
+            response = Response()
+            await trigger(bot, context, response)
+            response.send(message)
+            count += 1
+        return count / (time.perf_counter() - start)
+    
+    return asyncio.run(run())
+
+def generated_corpus(names: Iterable[str], count: int = 5000, mentions: int = 100) -> list[str]:
+    '''Generates a corpus of messages from the specified Markov chains, mentioning the bot every so often.'''
+    
+    markovs = [get_markov(name) for name in names]
+    corpus = [markovs[index % len(markovs)]() for index in range(count)]
+    for index in range(0, count, mentions):
+        corpus[index] = f'<@{StubClient.user.id}> {corpus[index]}'
+    
+    return corpus
+
+def dce_corpus(filenames: Iterable[str]) -> list[str]:
+    '''Collects every message in the specified DiscordChatExporter exports.'''
+    
+    return [content for filename in filenames for _, content in dce_authored_messages(filename)]
+
+def bench_replay(corpus: Iterable[str]) -> Tuple[float, float, float]:
+    '''Replays a corpus through the message handlers of the trigger and talk modules.
+    
+    Returns the messages handled per second and the median and 99th percentile latency in seconds.'''
+    
+    # the modules are set up exactly as the bot does, but against a stub client
+    client = StubClient()
+    bot = cast(Client, client)
+    triggers.setup(bot)
+    talk.setup(bot)
+    handlers = client.handlers.get('on_message', [])
+    messages = [cast(Message, StubMessage(content, 1)) for content in corpus]
+    
+    async def run() -> Tuple[float, list[float]]:
+        latencies: list[float] = []
+        start = time.perf_counter()
+        for message in messages:
+            # each message is examined once and dispatched to every handler at once, as in core.bot
+            sent = time.perf_counter()
+            context = MessageContext(bot, message)
+            if not context.ignored:
+                await asyncio.gather(*(handler(context) for handler in handlers))
+            latencies.append(time.perf_counter() - sent)
+        return time.perf_counter() - start, latencies
+    
+    elapsed, latencies = asyncio.run(run())
+    if len(latencies) < 2:
+        return 0.0, 0.0, 0.0
+    percentiles = statistics.quantiles(latencies, n=100)
+    return len(latencies) / elapsed, statistics.median(latencies), percentiles[98]
+
+def main() -> None:
+    '''Benchmarks every Markov chain in the data folder and every configured trigger.'''
+    
+    total = 0.0
+    names = sorted(name[:-6] for name in os.listdir(PATH) if name.endswith('.jason'))
+    for name in names:
+        rate = bench_markov(name)
+        total += rate
+        print(f'{name:>10}: {rate:10.0f} sentences/sec')
+    
+    print(f'{"mean":>10}: {total / max(len(names), 1):10.0f} sentences/sec')
+    
+    total = 0.0
+    for name in names:
+        rate = bench_seeded(name)
+        total += rate
+        print(f'{name:>10}: {rate:10.0f} sentences/sec (seeded)')
+    
+    print(f'{"mean":>10}: {total / max(len(names), 1):10.0f} sentences/sec (seeded)')
+    
+    total = 0.0
+    for name in names:
+        seconds = bench_load(name)
+        total += seconds
+        print(f'{name:>10}: {seconds * 1000:10.3f} ms to load')
+    
+    print(f'{"total":>10}: {total * 1000:10.3f} ms to load')
+    
+    # report how much memory each chain takes up, now that they have all been loaded
+    for name in names:
+        chain = CHAINS.get(name)
+        parts = ', '.join(f'{part} {size}' for part, size in chain.footprint().items())
+        print(f'{name:>10}: {chain.nbytes:10d} bytes at order {chain.order} ({parts})')
+    
+    try:
+        total = 0.0
+        for name in names:
+            rate = bench_batch(name)
+            total += rate
+            print(f'{name:>10}: {rate:10.0f} sentences/sec (batch)')
+        print(f'{"mean":>10}: {total / max(len(names), 1):10.0f} sentences/sec (batch)')
+    except ImportError:
+        print('numpy is not installed, skipping the batch engine...')
+    
+    configs = cast(list[dict[str, Any]], Config.get('triggers', []))
+    total = 0.0
+    for index, config in enumerate(configs):
+        rate = bench_trigger(config)
+        total += rate
+        print(f'{f"trigger {index}":>10}: {rate:10.0f} calls/sec ({config.get("type")})')
+    
+    print(f'{"mean":>10}: {total / max(len(configs), 1):10.0f} calls/sec')
+    
+    # replay real messages if any exports were provided, and generated ones otherwise
+    corpus = dce_corpus(sys.argv[1:]) if len(sys.argv) > 1 else generated_corpus(names)
+    rate, median, tail = bench_replay(corpus)
+    print(f'{"replay":>10}: {rate:10.0f} messages/sec ({len(corpus)} messages, p50 {median * 1000:.3f} ms, p99 {tail * 1000:.3f} ms)')
+    
+    # report the keyword patterns which took the most time during the replay
+    timings = sorted(triggers.table.timings(), key=lambda timing: timing[2], reverse=True)
+    for pattern, searches, total, slow in timings[:5]:
+        print(f'{"pattern":>10}: {total / max(searches, 1) * 1e6:10.2f} us/search ({searches} searches, {slow} slow) {pattern!r}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,524 @@
+import json, mmap, os, random, tempfile
+from array import array
+from bisect import bisect, bisect_left
+from typing import Callable, Mapping, Optional, Sequence, Tuple
+
+# Compiled Markov chains are stored as flat arrays of unsigned 32-bit integers
+# so that they can be memory-mapped and sampled without ever being parsed.
+#
+# The states of an order n chain are the last n words, which are stored in a
+# trie so that contexts sharing a prefix share nodes. Nodes are numbered level
+# by level, so the children of each node are contiguous and sorted by word id,
+# and the leaves (the full contexts) come last. Each edge also records the leaf
+# it leads to, so generating text never has to search the trie at all.
+#
+# Chains can be compiled to fit a size budget, in which case the rarest
+# transitions are pruned until they fit (see prune_markov).
+#
+# Replies can also be grown in both directions from a word in the middle, so
+# each chain carries the vocabulary sorted by text to look words up, the
+# leaves grouped by their newest word to find where a word can appear, and the
+# edges into each leaf to walk backwards towards the start of a message.
+#
+#   header:   magic, version, order, order of the counts it was compiled from,
+#             vocabulary size (V), node count (N), internal node count (I),
+#             edge count (E), reverse edge count (R), text size (T), the leaf
+#             that starts a message, and the size budget it was pruned to (or 0)
+#   words:    V + 1 offsets into the text delimiting each word (word 0 is '')
+#   labels:   N word ids, the newest word of the context each node represents
+#   children: I + 1 offsets into the labels delimiting each internal node's children
+#   leaves:   N - I + 1 offsets into the edges delimiting each leaf's successors
+#   targets:  E word ids, one per edge
+#   weights:  E cumulative weights, restarting at each leaf
+#   nexts:    E leaves reached by following each edge, or NONE at the end
+#   heads:    N - I word ids, the oldest word of each leaf's context
+#   inbound:  N - I + 1 offsets into the reverse edges delimiting each leaf's predecessors
+#   sources:  R leaves, each with an edge into the leaf
+#   backward: R cumulative weights of those edges, restarting at each leaf
+#   sorted:   V word ids, sorted by their text
+#   seeds:    V + 1 offsets into the endings delimiting each word's leaves
+#   endings:  N - I leaves, grouped by their newest word
+#   rooting:  N - I cumulative weights of those leaves, restarting at each word
+#   text:     T bytes of UTF-8, padded to a multiple of four
+
+MAGIC = 0x4B594F59
+VERSION = 5
+HEADER = 12
+NONE = 2**32 - 1
+EXTENSION = '.chain'
+
+def markov_order(markov: Mapping[str, Mapping[str, int]]) -> int:
+    '''Returns the order of a Markov chain of transition counts, whose keys are space-separated contexts.'''
+    
+    return len(next(iter(markov), '').split(' '))
+
+def reduce_order(markov: Mapping[str, Mapping[str, int]], order: int) -> dict[str, dict[str, int]]:
+    '''Reduces a Markov chain of transition counts to a lower order by forgetting the oldest words of each context.'''
+    
+    reduced: dict[str, dict[str, int]] = {}
+    for context, transitions in markov.items():
+        counts = reduced.setdefault(' '.join(context.split(' ')[-order:]), {})
+        for word, count in transitions.items():
+            counts[word] = counts.get(word, 0) + count
+    
+    return reduced
+
+def compiled_size(markov: Mapping[str, Mapping[str, int]]) -> int:
+    '''Returns the size in bytes of a Markov chain of transition counts once it is compiled.'''
+    
+    words = {''}
+    prefixes: set[Tuple[str, ...]] = set()
+    edges = 0
+    reverse = 0
+    for context, transitions in markov.items():
+        split = tuple(context.split(' '))
+        words.update(split)
+        words.update(transitions)
+        prefixes.update(split[:depth] for depth in range(1, len(split) + 1))
+        edges += len(transitions)
+        reverse += sum(1 for word in transitions if word and ' '.join((*split[1:], word)) in markov)
+    
+    # the root node and the offset arrays' extra entries are counted alongside the sections
+    text = sum(len(word.encode('utf8')) for word in words)
+    nodes = len(prefixes) + 1
+    leaves = len(markov)
+    vocabulary = 3 * len(words) + 2
+    trie = nodes + nodes + 2 + 4 * leaves + 1
+    return 4 * (HEADER + vocabulary + trie + 3 * edges + 2 * reverse) + text + -text % 4
+
+def prune_markov(markov: Mapping[str, Mapping[str, int]], budget: int) -> dict[str, dict[str, int]]:
+    '''Drops the rarest transitions of a Markov chain of transition counts until it compiles within the budget in bytes.
+    
+    Each context keeps its most common transition, so every walk can still reach the end of a message,
+    and contexts which can no longer be reached from the start are dropped along with their transitions.
+    If even that is too large, the chain is pruned as far as it can be.'''
+    
+    order = markov_order(markov)
+    start = ' '.join([''] * order)
+    
+    # every transition but the most common of each context may be dropped, rarest first
+    candidates: list[Tuple[int, str, str]] = []
+    for context, transitions in markov.items():
+        top = max(transitions, key=lambda word: transitions[word], default=None)
+        candidates.extend((count, context, word) for word, count in transitions.items() if word != top)
+    candidates.sort(key=lambda candidate: candidate[0])
+    
+    def prune(count: int) -> dict[str, dict[str, int]]:
+        '''Drops the specified number of candidates, then any contexts left unreachable.'''
+        
+        dropped = {(context, word) for _, context, word in candidates[:count]}
+        pruned: dict[str, dict[str, int]] = {}
+        stack = [start] if start in markov else []
+        while stack:
+            context = stack.pop()
+            if context in pruned:
+                continue
+            
+            transitions = pruned[context] = {word: count for word, count in markov[context].items() if (context, word) not in dropped}
+            shifted = context.split(' ')[1:]
+            for word in transitions:
+                next = ' '.join(shifted + [word])
+                if word and next not in pruned and next in markov:
+                    stack.append(next)
+        
+        return pruned
+    
+    # dropping more transitions never makes the chain larger, so the fewest that fit are found by bisection
+    low, high = 0, len(candidates)
+    if compiled_size(markov) <= budget:
+        return {context: dict(transitions) for context, transitions in markov.items()}
+    while low < high:
+        middle = (low + high) // 2
+        if compiled_size(prune(middle)) <= budget:
+            high = middle
+        else:
+            low = middle + 1
+    
+    return prune(low)
+
+def compile_markov(markov: Mapping[str, Mapping[str, int]], order: Optional[int] = None, budget: Optional[int] = None) -> bytes:
+    '''Converts a Markov chain of transition counts into the compiled format, optionally at a lower order or within a size budget.'''
+    
+    source = markov_order(markov)
+    order = min(order or source, source)
+    if order < source:
+        markov = reduce_order(markov, order)
+    if budget:
+        markov = prune_markov(markov, budget)
+    
+    # assign every word an id, reserving 0 for the start and end of a message
+    ids: dict[str, int] = {'': 0}
+    contexts: dict[Tuple[int, ...], Mapping[str, int]] = {}
+    for context, transitions in markov.items():
+        for word in (*context.split(' '), *transitions):
+            ids.setdefault(word, len(ids))
+        contexts[tuple(ids[word] for word in context.split(' '))] = transitions
+    
+    text = bytearray()
+    words = array('I', [0])
+    for word in ids:
+        text += word.encode('utf8')
+        words.append(len(text))
+    text += bytes(-len(text) % 4)
+    
+    # number the nodes level by level, sorting each level so that siblings are contiguous
+    levels: list[list[Tuple[int, ...]]] = [[()]]
+    for depth in range(1, order + 1):
+        levels.append(sorted({context[:depth] for context in contexts}))
+    
+    labels = array('I', [0])
+    children = array('I')
+    for depth in range(1, order + 1):
+        parents = levels[depth - 1]
+        index = 0
+        for parent in parents:
+            children.append(len(labels))
+            while index < len(levels[depth]) and levels[depth][index][:-1] == parent:
+                labels.append(levels[depth][index][-1])
+                index += 1
+    children.append(len(labels))
+    
+    # lay out the successors of each leaf contiguously, in leaf order
+    leaves = {context: index for index, context in enumerate(levels[order])}
+    offsets = array('I', [0])
+    targets = array('I')
+    weights = array('I')
+    nexts = array('I')
+    for context in levels[order]:
+        total = 0
+        for word, count in contexts[context].items():
+            total += count
+            target = ids[word]
+            targets.append(target)
+            weights.append(total)
+            nexts.append(leaves.get((*context[1:], target), NONE) if target else NONE)
+        offsets.append(len(targets))
+    
+    # collect the edges into each leaf, and the leaves ending in each word, for growing replies from a word
+    heads = array('I', [context[0] for context in levels[order]])
+    predecessors: list[list[Tuple[int, int]]] = [[] for _ in levels[order]]
+    for leaf in range(len(levels[order])):
+        for edge in range(offsets[leaf], offsets[leaf + 1]):
+            if nexts[edge] != NONE:
+                previous = weights[edge - 1] if edge > offsets[leaf] else 0
+                predecessors[nexts[edge]].append((leaf, weights[edge] - previous))
+    
+    inbound = array('I', [0])
+    sources = array('I')
+    backward = array('I')
+    for edges in predecessors:
+        total = 0
+        for leaf, count in edges:
+            total += count
+            sources.append(leaf)
+            backward.append(total)
+        inbound.append(len(sources))
+    
+    endings = array('I', sorted(range(len(levels[order])), key=lambda leaf: levels[order][leaf][-1]))
+    seeds = array('I', [0] * (len(ids) + 1))
+    for context in levels[order]:
+        seeds[context[-1] + 1] += 1
+    for id in range(len(ids)):
+        seeds[id + 1] += seeds[id]
+    
+    # each leaf is weighted by how often its context occurs, so seeding from a word is a single binary search
+    rooting = array('I')
+    for id in range(len(ids)):
+        total = 0
+        for leaf in endings[seeds[id]:seeds[id + 1]]:
+            total += weights[offsets[leaf + 1] - 1] if offsets[leaf + 1] > offsets[leaf] else 0
+            rooting.append(total)
+    
+    ordered = array('I', sorted(range(len(ids)), key=lambda id: text[words[id]:words[id + 1]]))
+    
+    start = leaves.get((0,) * order, NONE)
+    header = array('I', [MAGIC, VERSION, order, source, len(ids), len(labels), len(children) - 1, len(targets), len(sources), len(text), start, budget or 0])
+    sections = [header, words, labels, children, offsets, targets, weights, nexts, heads, inbound, sources, backward, ordered, seeds, endings, rooting]
+    return b''.join([section.tobytes() for section in sections] + [bytes(text)])
+
+def compile_file(source: str, target: str, order: Optional[int] = None, budget: Optional[int] = None) -> None:
+    '''Compiles a Markov chain stored as JSON transition counts into the specified file.'''
+    
+    with open(source, encoding='utf8') as file:
+        data = compile_markov(json.loads(file.read()), order, budget)
+    
+    # write to a temporary file first so that readers never see a partial chain
+    # the name is unique, so processes compiling the same chain at once do not write over each other
+    handle, temp = tempfile.mkstemp(dir=os.path.dirname(target) or '.', prefix=f'{os.path.basename(target)}.', suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            file.write(data)
+        os.replace(temp, target)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+class Chain():
+    '''A compiled Markov chain backed by a memory-mapped file.'''
+    
+    order: int
+    source_order: int
+    start: int
+    budget: int
+    _map: mmap.mmap
+    _offset: int
+    _views: list[memoryview]
+    _words: memoryview
+    _labels: memoryview
+    _children: memoryview
+    _leaves: memoryview
+    _targets: memoryview
+    _weights: memoryview
+    _nexts: memoryview
+    _heads: memoryview
+    _inbound: memoryview
+    _sources: memoryview
+    _backward: memoryview
+    _sorted: memoryview
+    _seeds: memoryview
+    _endings: memoryview
+    _rooting: memoryview
+    _text: memoryview
+    
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        view = memoryview(self._map)
+        header = view[:HEADER * 4].cast('I')
+        if header[0] != MAGIC or header[1] != VERSION:
+            header.release()
+            view.release()
+            self._map.close()
+            raise ValueError(f'{filename} is not a version {VERSION} Markov chain!')
+        
+        _, _, self.order, self.source_order, size, nodes, internal, edges, reverse, length, self.start, self.budget = header
+        header.release()
+        
+        # slice each section out of the mapping without copying it
+        sections: list[memoryview] = []
+        offset = HEADER * 4
+        leaves = nodes - internal
+        for count in (size + 1, nodes, internal + 1, leaves + 1, edges, edges, edges, leaves, leaves + 1, reverse, reverse, size, size + 1, leaves, leaves):
+            sections.append(view[offset:offset + count * 4].cast('I'))
+            offset += count * 4
+        sections.append(view[offset:offset + length])
+        self._offset = offset
+        
+        self._words, self._labels, self._children, self._leaves, self._targets, self._weights, self._nexts = sections[:7]
+        self._heads, self._inbound, self._sources, self._backward, self._sorted, self._seeds, self._endings, self._rooting, self._text = sections[7:]
+        self._views = [*sections, view]
+    
+    @property
+    def nbytes(self) -> int:
+        '''The size of the compiled chain in bytes.'''
+        
+        return len(self._map)
+    
+    @property
+    def size(self) -> int:
+        '''The number of words in the vocabulary, including the empty word.'''
+        
+        return len(self._words) - 1
+    
+    def footprint(self) -> dict[str, int]:
+        '''Returns the number of bytes taken up by each part of the compiled chain.'''
+        
+        return {
+            'vocabulary': self._words.nbytes + self._text.nbytes,
+            'trie': self._labels.nbytes + self._children.nbytes + self._leaves.nbytes,
+            'edges': self._targets.nbytes + self._weights.nbytes + self._nexts.nbytes,
+            'index': sum(view.nbytes for view in (self._heads, self._inbound, self._sources, self._backward, self._sorted, self._seeds, self._endings, self._rooting)),
+        }
+    
+    def arrays(self) -> Tuple[memoryview, memoryview, memoryview, memoryview]:
+        '''Returns the leaf offsets, edge targets, cumulative edge weights and next leaves, for sampling in bulk.'''
+        
+        return self._leaves, self._targets, self._weights, self._nexts
+    
+    def word(self, id: int) -> str:
+        '''Returns the text of the word with the specified id.'''
+        
+        return str(self._text[self._words[id]:self._words[id + 1]], 'utf8')
+    
+    def find(self, context: Sequence[int]) -> int:
+        '''Returns the leaf for the specified context of word ids, or NONE if it never occurs.'''
+        
+        internal = len(self._children) - 1
+        node = 0
+        for id in context:
+            if node >= internal:
+                return NONE
+            
+            # the children of each node are sorted by word id
+            start, end = self._children[node], self._children[node + 1]
+            node = bisect_left(self._labels, id, start, end)
+            if node == end or self._labels[node] != id:
+                return NONE
+        
+        return node - internal
+    
+    def choose(self, leaf: int) -> int:
+        '''Chooses a random edge to follow from the provided leaf, or returns NONE if there are none.'''
+        
+        start, end = self._leaves[leaf], self._leaves[leaf + 1]
+        if start == end:
+            return NONE
+        
+        # the weights are cumulative, so a binary search finds the chosen edge
+        total = self._weights[end - 1]
+        return bisect(self._weights, random.random() * total, start, end)
+    
+    def lookup(self, word: str) -> int:
+        '''Returns the id of the specified word, or NONE if it is not in the vocabulary.'''
+        
+        # slicing the mapping itself gives bytes to compare without going through a view
+        encoded = word.encode('utf8')
+        words, data, offset = self._words, self._map, self._offset
+        key: Callable[[int], bytes] = lambda id: data[offset + words[id]:offset + words[id + 1]]
+        index = bisect_left(self._sorted, encoded, key=key)
+        if index < len(self._sorted) and key(self._sorted[index]) == encoded:
+            return self._sorted[index]
+        return NONE
+    
+    def context(self, leaf: int) -> list[int]:
+        '''Returns the word ids of the context the specified leaf represents, oldest first.'''
+        
+        # each node's parent is the internal node whose children include it
+        ids: list[int] = []
+        node = leaf + len(self._children) - 1
+        while node:
+            ids.append(self._labels[node])
+            node = bisect(self._children, node) - 1
+        
+        return ids[::-1]
+    
+    def seed(self, id: int) -> int:
+        '''Chooses a random leaf whose context ends in the specified word, weighted by how often each occurs, or returns NONE if there are none.'''
+        
+        start, end = self._seeds[id], self._seeds[id + 1]
+        if start == end:
+            return NONE
+        
+        # the weights are cumulative, so a binary search finds the chosen leaf
+        total = self._rooting[end - 1]
+        if not total:
+            return self._endings[start]
+        return self._endings[bisect(self._rooting, random.random() * total, start, end)]
+    
+    def generate(self, limit: Optional[int] = None, truncate: bool = False) -> Optional[str]:
+        '''Generates a message using the Markov chain, or None if it runs longer than the limit in characters.
+        
+        If truncating, the walk instead stops at the limit and the message is cut short after its last whole word.'''
+        
+        words = self._forward(self.start, [], limit, truncate)
+        return None if words is None else ' '.join(words)
+    
+    def grow(self, word: str, limit: Optional[int] = None) -> Optional[str]:
+        '''Generates a message containing the specified word by walking from it in both directions,
+        or None if the word never occurs or the message runs longer than the limit in characters.'''
+        
+        id = self.lookup(word)
+        leaf = NONE if id == NONE else self.seed(id)
+        if leaf == NONE:
+            return None
+        
+        # the context around the word is kept, apart from the padding at the start of a message
+        words = [self.word(id) for id in self.context(leaf) if id]
+        length = sum(len(word) + 1 for word in words) - 1
+        
+        # walk backwards until reaching the start of a message, then forwards until reaching the end
+        # predecessors are weighted by how often their edge was taken, so both halves follow the counts
+        prefix: list[str] = []
+        current = leaf
+        while True:
+            start, end = self._inbound[current], self._inbound[current + 1]
+            if start == end:
+                break
+            
+            current = self._sources[bisect(self._backward, random.random() * self._backward[end - 1], start, end)]
+            if not self._heads[current]:
+                break
+            
+            word = self.word(self._heads[current])
+            prefix.append(word)
+            length += len(word) + 1
+            if limit is not None and length > limit:
+                return None
+        
+        words = self._forward(leaf, prefix[::-1] + words, limit)
+        return None if words is None else ' '.join(words)
+    
+    def _forward(self, leaf: int, words: list[str], limit: Optional[int], truncate: bool = False) -> Optional[list[str]]:
+        '''Appends words to a message by walking forwards from the leaf, or returns None if it runs longer than the limit in characters.
+        
+        If truncating, the words up to the limit are returned instead.'''
+        
+        length = sum(len(word) + 1 for word in words) - 1
+        leaves, targets, weights, nexts = self.arrays()
+        
+        # word 0 represents the start and end of the message
+        while leaf != NONE:
+            start, end = leaves[leaf], leaves[leaf + 1]
+            if start == end:
+                break
+            
+            # this is choose, inlined since it runs for every word
+            edge = bisect(weights, random.random() * weights[end - 1], start, end)
+            if not targets[edge]:
+                break
+            
+            word = self.word(targets[edge])
+            length += len(word) + 1
+            if limit is not None and length > limit:
+                return words if truncate else None
+            words.append(word)
+            leaf = nexts[edge]
+        
+        return words
+    
+    def close(self) -> None:
+        '''Releases the memory-mapped file.'''
+        
+        for view in self._views:
+            view.release()
+        self._map.close()
+
+def compiled_budget(target: str) -> int:
+    '''Reads the budget a compiled chain was pruned to, or 0 if it was not pruned or cannot be read.'''
+    
+    try:
+        with open(target, 'rb') as file:
+            header = array('I', file.read(HEADER * 4))
+    except (FileNotFoundError, ValueError):
+        return 0
+    
+    return header[11] if len(header) == HEADER and header[0] == MAGIC and header[1] == VERSION else 0
+
+def load(source: str, order: Optional[int] = None, budget: Optional[int] = None) -> Chain:
+    '''Loads the compiled version of a JSON Markov chain, compiling it first if it is missing, stale, or of another order or budget.
+    
+    Without a budget (None or 0), a chain keeps whatever budget it was last compiled with, such as one set by util.markov.convert,
+    even when it is recompiled because the JSON has changed.'''
+    
+    target = os.path.splitext(source)[0] + EXTENSION
+    budget = budget or compiled_budget(target)
+    if os.path.exists(source) and (not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(source)):
+        compile_file(source, target, order, budget)
+    
+    try:
+        chain = Chain(target)
+    except ValueError:
+        # chains compiled by an older version of this module are rebuilt
+        compile_file(source, target, order, budget)
+        return Chain(target)
+    
+    # chains compiled at a different order or budget than requested are rebuilt too
+    stale = order is not None and chain.order != min(order, chain.source_order)
+    stale = stale or bool(budget) and chain.budget != budget
+    if stale and os.path.exists(source):
+        chain.close()
+        compile_file(source, target, order, budget)
+        chain = Chain(target)
+    
+    return chain
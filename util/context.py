@@ -0,0 +1,33 @@
+from discord import Client, Message
+from functools import cached_property
+
+from util.debug import DEBUG, DEBUG_GUILD
+
+class MessageContext():
+    '''The details of a message which every handler needs, worked out once when the message arrives.'''
+    
+    message: Message
+    content: str
+    ignored: bool
+    mentioned: bool
+    
+    def __init__(self, bot: Client, message: Message):
+        self.message = message
+        self.content = message.content
+        
+        # messages sent by the bot are ignored to prevent infinite loops
+        # in debug mode, so is everything outside of direct messages and the debug server
+        self.ignored = message.author == bot.user or (DEBUG and not (message.guild is None or message.guild.id == DEBUG_GUILD.id))
+        self.mentioned = bot.user is not None and bot.user.mentioned_in(message)
+    
+    @cached_property
+    def lowered(self) -> str:
+        '''The content of the message in lowercase.'''
+        
+        return self.content.lower()
+    
+    @cached_property
+    def words(self) -> list[str]:
+        '''The words of the message as written, split on whitespace.'''
+        
+        return self.content.split()
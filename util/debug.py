@@ -1,21 +1,69 @@
-import discord
+import asyncio, atexit, discord, json, logging, os, sys, time
 from contextlib import contextmanager
-from typing import Any, Generator, Optional, Tuple, Type
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Any, Generator, Optional, Tuple, Type, cast
 
-async def set_status(bot: discord.Client, message: str) -> None:
-    '''Logs a message to the bot's status and the console.'''
+# Log records are put on a queue and written out by a background thread, so
+# logging from a handler never waits on the console. Each record can carry
+# structured fields (such as the toe, trigger, latency or exception involved),
+# which are written as key=value pairs, or as JSON lines if LOG_FORMAT=json.
+
+class StructuredFormatter(logging.Formatter):
+    '''Formats log records and their structured fields as readable text or as JSON lines.'''
+    
+    def format(self, record: logging.LogRecord) -> str:
+        fields = cast(dict[str, Any], getattr(record, 'fields', {}))
+        message = record.getMessage()
+        
+        if json_logs:
+            return json.dumps({'time': record.created, 'level': record.levelname.lower(), 'message': message, **fields}, default=str, ensure_ascii=False)
+        
+        # errors stand out from the rest of the output
+        if record.levelno >= logging.ERROR:
+            lines = ['===ERROR!===', f'ǁ {message}', *(f'ǁ {key}: {value}' for key, value in fields.items()), '============']
+            return '\n'.join(lines)
+        
+        if fields:
+            message += ' [' + ', '.join(f'{key}={value}' for key, value in fields.items()) + ']'
+        return message
+
+json_logs: bool = False
+logger: logging.Logger = logging.getLogger('kyoyobot')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+def start_logging() -> None:
+    '''Routes the logger through a fresh queue to a new background thread which writes to the console.'''
+    
+    global listener
+    queue: SimpleQueue[logging.LogRecord] = SimpleQueue()
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(StructuredFormatter())
+    
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(queue))
+    
+    listener = QueueListener(queue, console)
+    listener.start()
+
+listener: QueueListener
+start_logging()
+
+# the thread does not survive forking, so shard processes start their own, and records still queued are written on exit
+os.register_at_fork(after_in_child=start_logging)
+atexit.register(lambda: listener.stop())
+
+def log(message: str, level: int = logging.INFO, **fields: Any) -> None:
+    '''Logs a message to the console, along with any structured fields.'''
     
-    await bot.change_presence(activity=discord.Game(name=message))
-    print(message)
+    logger.log(level, message, extra={'fields': fields})
 
-def error(e: Exception, msg: Optional[str] = None) -> None:
+def error(e: Exception, msg: Optional[str] = None, **fields: Any) -> None:
     '''Logs an error to the console.'''
     
-    print('===ERROR!===')
-    if msg is not None:
-        print(f'ǁ {msg}')
-    print(f'ǁ {repr(e)}')
-    print('============')
+    log(msg or type(e).__name__, logging.ERROR, **fields, exception=repr(e))
 
 @contextmanager
 def catch(types: Type[Any] | Tuple[Type[Any], ...], msg: Optional[str] = None) -> Generator[None, None, None]:
@@ -29,10 +77,53 @@ def catch(types: Type[Any] | Tuple[Type[Any], ...], msg: Optional[str] = None) -
             error(e, msg)
         else:
             raise
+
+class Presence():
+    '''Coalesces changes to the bot's status, so that discord receives at most one per interval.'''
+    
+    _message: Optional[str]
+    _sent: float
+    _task: Optional['asyncio.Task[None]']
+    
+    def __init__(self):
+        self._message = None
+        self._sent = float('-inf')
+        self._task = None
+    
+    def update(self, bot: discord.Client, message: str) -> None:
+        '''Schedules the status to change, replacing any change which has not been sent yet.'''
+        
+        self._message = message
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush(bot))
     
+    async def _flush(self, bot: discord.Client) -> None:
+        '''Sends the latest status whenever the interval allows, until there are no more changes.'''
+        
+        while self._message is not None:
+            delay = self._sent + cast(float, Config.get('status_interval', 5)) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            
+            message, self._message = self._message, None
+            self._sent = time.monotonic()
+            try:
+                await bot.change_presence(activity=discord.Game(name=message))
+            except Exception as e:
+                error(e, 'Debug :: Failed to update the status!', status=message)
+
+presence = Presence()
+
+async def set_status(bot: discord.Client, message: str) -> None:
+    '''Logs a message to the console and shows it as the bot's status once the presence rate limit allows.'''
+    
+    presence.update(bot, message)
+    log(message)
+
 
 # moved to prevent circular import
-from util.settings import Env
+from util.settings import Config, Env
 
 DEBUG: bool = bool(Env.get('DEBUG', False))
 DEBUG_GUILD: discord.Object = discord.Object(id=str(Env.get('DEBUG_GUILD', 1059681961515425793)))
+json_logs = Env.get('LOG_FORMAT') == 'json'
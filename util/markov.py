@@ -1,32 +1,151 @@
-import json
-from typing import Any, Iterable
+import hashlib, json, math, os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterable, Iterator, Mapping, Optional, Sequence, Tuple, TypeVar
+
+from util.chain import EXTENSION, compile_file, compiled_size, markov_order, prune_markov
+from util.debug import error
 
 # This module is not for use with the bot, but rather as additional utility.
 
-def dce_to_messages(filenames: Iterable[str], users: dict[str, str]):
-    '''Extracts the specified user's messages from a set of DiscordChatExporter exports.'''
+PARTIALS = 'data/partials/'
+MANIFEST = f'{PARTIALS}manifest.jason'
+
+T = TypeVar('T')
+U = TypeVar('U')
+
+def parallel_map(function: Callable[[T], U], items: Iterable[T], processes: Optional[int] = 1) -> Iterator[U]:
+    '''Maps the function over the items, in a process pool if more than one process (or None, for one per core) is requested.'''
     
-    output: dict[str, list[str]] = {user: [] for user in users.values()}
+    if processes == 1:
+        yield from map(function, items)
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            yield from executor.map(function, items)
+
+def dce_stream(filename: str, chunk_size: int = 2**16) -> Iterator[dict[str, Any]]:
+    '''Yields the messages in a DiscordChatExporter export one at a time without reading the whole file.'''
     
-    for filename in filenames:
-        # attempt to load each file in JSON format
-        try:
-            with open(filename, encoding='utf8') as file:
-                messages: list[dict[str, Any]] = json.loads(file.read()).get('messages', [])
-        except:
-            messages = []
-        
-        # check if the message is valid, and collect it if so
-        for message in messages:
-            user = users.get(message.get('author', {}).get('id', ''))
+    decoder = json.JSONDecoder()
+    
+    with open(filename, encoding='utf8') as file:
+        buffer = ''
+        position = 0
+        finished = False
+        
+        def fill() -> bool:
+            '''Reads another chunk of the file, discarding what has already been parsed.'''
+            
+            nonlocal buffer, position, finished
+            chunk = file.read(chunk_size)
+            buffer = buffer[position:] + chunk
+            position = 0
+            finished = not chunk
+            return not finished
+        
+        def peek() -> str:
+            '''Skips whitespace and returns the next character, or an empty string at the end of the file.'''
+            
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n':
+                    position += 1
+                if position < len(buffer) or not fill():
+                    return buffer[position:position + 1]
+        
+        def expect(characters: str) -> str:
+            '''Consumes the next character, which must be one of the specified characters.'''
+            
+            nonlocal position
+            character = peek()
+            if not character or character not in characters:
+                raise ValueError(f'Expected one of "{characters}" in {filename} but found "{character}"!')
+            position += 1
+            return character
+        
+        def value() -> Any:
+            '''Decodes the next JSON value, reading more of the file until it is complete.'''
+            
+            nonlocal position
+            peek()
+            while True:
+                try:
+                    obj, end = decoder.raw_decode(buffer, position)
+                    # a value touching the end of the buffer (like a number) might continue in the next chunk
+                    if end < len(buffer) or finished or not fill():
+                        position = end
+                        return obj
+                except json.JSONDecodeError:
+                    if not fill():
+                        raise
+        
+        # walk the top-level object until the message list is found
+        expect('{')
+        while peek() != '}':
+            key = value()
+            expect(':')
+            if key != 'messages':
+                value()
+                if expect(',}') == '}':
+                    return
+                continue
+            
+            # yield each message in the list as soon as it is parsed
+            expect('[')
+            if peek() != ']':
+                while True:
+                    yield value()
+                    if expect(',]') == ']':
+                        break
+            return
+
+def dce_authored_messages(filename: str) -> Iterator[Tuple[str, str]]:
+    '''Yields the author ID and content of each valid message in a single DiscordChatExporter export.'''
+    
+    # files which fail to parse or read keep whatever was collected before the error,
+    # but anything else (such as an interrupt) still stops the run
+    try:
+        for message in dce_stream(filename):
+            author = message.get('author', {}).get('id', '')
             content = message.get('content')
-            if user and content and message.get('type') == 'Default':
-                output[user].append(content)
+            if author and content and message.get('type') == 'Default':
+                yield author, content
+    except (ValueError, OSError, UnicodeDecodeError, AttributeError) as e:
+        error(e, f'Markov :: Stopped reading {filename} early!')
+
+def dce_file_to_messages(filename: str, users: dict[str, str]) -> dict[str, list[str]]:
+    '''Extracts the specified users' messages from a single DiscordChatExporter export.'''
+    
+    output: dict[str, list[str]] = {user: [] for user in users.values()}
+    
+    # collect each message written by one of the users
+    for author, content in dce_authored_messages(filename):
+        user = users.get(author)
+        if user:
+            output[user].append(content)
     
     return output
 
-def messages_to_markov(messages: Iterable[str]):
-    '''Builds a Markov chain from the provided list of messages.'''
+def dce_to_messages(filenames: Iterable[str], users: dict[str, str], processes: Optional[int] = 1):
+    '''Extracts the specified user's messages from a set of DiscordChatExporter exports.
+    
+    With more than one process (or None, for one per core), the files are parsed in parallel.'''
+    
+    output: dict[str, list[str]] = {user: [] for user in users.values()}
+    
+    def merge(results: Iterable[dict[str, list[str]]]) -> None:
+        '''Merges the messages from each file into the output, in file order.'''
+        
+        for result in results:
+            for user, messages in result.items():
+                output[user].extend(messages)
+    
+    merge(parallel_map(partial(dce_file_to_messages, users=users), filenames, processes))
+    
+    return output
+
+def messages_to_markov(messages: Iterable[str], order: int = 1):
+    '''Builds a Markov chain from the provided list of messages, in which each word depends on the previous few.'''
     
     obj: dict[str, dict[str, int]] = {}
     
@@ -40,21 +159,209 @@ def messages_to_markov(messages: Iterable[str]):
             obj[current][next] = 0
         
         obj[current][next] += 1
-
-    # processes each adjacent pair of words to build the transitions
+    
+    # processes each run of words to build the transitions, keyed by the space-separated context
     for message in messages:
         words = message.split()
-        current = '' # represents the start and end of the message
+        context = [''] * order # represents the start and end of the message
         
         for next in words:
-            add_transition(current, next)
-            current = next
-        add_transition(current, '')
+            add_transition(' '.join(context), next)
+            context = context[1:] + [next]
+        add_transition(' '.join(context), '')
     
     return obj
 
-def export(markov: dict[str, Any], name: str):
-    '''Saves a Markov chain with the specified name.'''
+def perplexity(markov: Mapping[str, Mapping[str, int]], messages: Iterable[str], vocabulary: Optional[int] = None) -> float:
+    '''Measures how surprised a Markov chain is by the provided messages, where lower is better.
+    
+    Every word is given one extra count so that transitions the chain has never seen are not
+    impossible. Chains are only comparable when measured against the same vocabulary size,
+    which defaults to the number of words the chain can produce.'''
+    
+    if vocabulary is None:
+        vocabulary = len({word for transitions in markov.values() for word in transitions})
+    
+    order = markov_order(markov)
+    totals: dict[str, int] = {}
+    surprise = 0.0
+    count = 0
+    
+    # walks each message the same way as messages_to_markov
+    for message in messages:
+        context = [''] * order
+        for next in message.split() + ['']:
+            key = ' '.join(context)
+            transitions = markov.get(key, {})
+            if key not in totals:
+                totals[key] = sum(transitions.values())
+            surprise -= math.log((transitions.get(next, 0) + 1) / (totals[key] + vocabulary))
+            count += 1
+            context = context[1:] + [next]
+    
+    return math.exp(surprise / count) if count else 1.0
+
+def prune_report(messages: Sequence[str], budgets: Iterable[int], order: int = 1, held_out: float = 0.1) -> list[dict[str, float]]:
+    '''Measures what pruning a Markov chain built from the provided messages to each budget in bytes would save and cost.
+    
+    The chain is built from all but the last portion of the messages, which are held out to
+    measure the perplexity of each pruned chain. The first row describes the unpruned chain.'''
+    
+    split = len(messages) - int(len(messages) * held_out)
+    markov = messages_to_markov(messages[:split], order)
+    vocabulary = len({word for transitions in markov.values() for word in transitions})
+    size = compiled_size(markov)
+    
+    report: list[dict[str, float]] = []
+    for budget in [0, *budgets]:
+        pruned = prune_markov(markov, budget) if budget else markov
+        pruned_size = compiled_size(pruned)
+        report.append({
+            'budget': budget,
+            'bytes': pruned_size,
+            'saved': size - pruned_size,
+            'transitions': sum(len(transitions) for transitions in pruned.values()),
+            'perplexity': perplexity(pruned, messages[split:], vocabulary),
+        })
+    
+    return report
+
+def export(markov: dict[str, Any], name: str, budget: Optional[int] = None):
+    '''Saves a Markov chain with the specified name, compiling it within the size budget in bytes, if any.
+    
+    The saved counts are never pruned, so a chain can always be recompiled with a larger budget.'''
     
     with open(f'data/markov/{name}.jason', 'w') as file:
         file.write(json.dumps(markov))
+    
+    convert([name], budget)
+
+def convert(names: Optional[Iterable[str]] = None, budget: Optional[int] = None):
+    '''Compiles the saved Markov chains with the specified names (or all of them) into the binary format used by the bot.'''
+    
+    if names is None:
+        names = [name[:-6] for name in os.listdir('data/markov') if name.endswith('.jason')]
+    
+    for name in names:
+        compile_file(f'data/markov/{name}.jason', f'data/markov/{name}{EXTENSION}', budget=budget)
+
+def merge_markov(markov: dict[str, dict[str, int]], other: Mapping[str, Mapping[str, int]]):
+    '''Adds the transition counts of another Markov chain into the first one.'''
+    
+    for current, transitions in other.items():
+        counts = markov.setdefault(current, {})
+        for next, count in transitions.items():
+            counts[next] = counts.get(next, 0) + count
+    
+    return markov
+
+def file_hash(filename: str) -> str:
+    '''Computes a hash of the contents of the specified file.'''
+    
+    hash = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        while chunk := file.read(2**20):
+            hash.update(chunk)
+    
+    return hash.hexdigest()
+
+def dce_file_to_partial(filename: str, order: int = 1) -> dict[str, dict[str, dict[str, int]]]:
+    '''Builds a Markov chain of the specified order for every author in a single DiscordChatExporter export.'''
+    
+    messages: dict[str, list[str]] = {}
+    for author, content in dce_authored_messages(filename):
+        messages.setdefault(author, []).append(content)
+    
+    return {author: messages_to_markov(contents, order) for author, contents in messages.items()}
+
+def update(filenames: Iterable[str], users: dict[str, str], processes: Optional[int] = 1, rebuild: bool = False, order: int = 1, budget: Optional[int] = None):
+    '''Updates the specified users' Markov chains with any DiscordChatExporter exports not yet processed.
+    
+    The counts from each export are saved in PARTIALS, keyed by a hash of its contents, so an export
+    is only ever parsed once. New counts are merged into the existing chains, unless rebuilding, in
+    which case the chains are rebuilt from the saved counts of all of the specified exports. Counts
+    of each order are saved separately, and chains of a different order must be rebuilt. The
+    compiled chains are pruned to the size budget in bytes, if any.
+    
+    Which exports have been merged into each user's chain is recorded in MANIFEST, only once the
+    chain has been saved, so a run which fails part way through merges the same exports next time.'''
+    
+    os.makedirs(PARTIALS, exist_ok=True)
+    
+    # hashing is skipped for files whose size and modification time have not changed
+    index: dict[str, list[Any]] = {}
+    try:
+        with open(f'{PARTIALS}index.jason', encoding='utf8') as file:
+            index = json.loads(file.read())
+    except (json.decoder.JSONDecodeError, FileNotFoundError):
+        pass
+    
+    filenames = list(filenames)
+    hashes: list[str] = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        key = os.path.abspath(filename)
+        entry = index.get(key)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            entry = index[key] = [stat.st_size, stat.st_mtime_ns, file_hash(filename)]
+        hashes.append(entry[2])
+    
+    with open(f'{PARTIALS}index.jason', 'w', encoding='utf8') as file:
+        file.write(json.dumps(index))
+    
+    # a manifest which cannot be read would merge exports into chains that already contain them
+    manifest: dict[str, list[str]] = {}
+    try:
+        with open(MANIFEST, encoding='utf8') as file:
+            manifest = json.loads(file.read())
+    except FileNotFoundError:
+        pass
+    except json.decoder.JSONDecodeError as e:
+        raise ValueError(f'{MANIFEST} is corrupted, so it must be deleted and the chains rebuilt!') from e
+    
+    # parse only the exports whose contents have not been seen before
+    # the counts are written to a temporary file first so that a run which fails part way through never leaves a partial file behind
+    new = {hash: filename for filename, hash in zip(filenames, hashes) if not os.path.exists(f'{PARTIALS}{hash}-{order}.jason')}
+    for hash, counts in zip(new, parallel_map(partial(dce_file_to_partial, order=order), new.values(), processes)):
+        with open(f'{PARTIALS}{hash}-{order}.jason.tmp', 'w', encoding='utf8') as file:
+            file.write(json.dumps(counts))
+        os.replace(f'{PARTIALS}{hash}-{order}.jason.tmp', f'{PARTIALS}{hash}-{order}.jason')
+    
+    # each chain needs the exports which have not been merged into it yet, or all of them when rebuilding
+    unique = list(dict.fromkeys(hashes))
+    pending = {user: [hash for hash in unique if rebuild or hash not in manifest.get(user, [])] for user in users.values()}
+    
+    # load the existing chains, unless they are being rebuilt from scratch
+    chains: dict[str, dict[str, dict[str, int]]] = {user: {} for user in users.values()}
+    if not rebuild:
+        for user in chains:
+            try:
+                with open(f'data/markov/{user}.jason', encoding='utf8') as file:
+                    chains[user] = json.loads(file.read())
+            except FileNotFoundError:
+                pass
+            if chains[user] and markov_order(chains[user]) != order:
+                raise ValueError(f'The Markov chain for {user} is not of order {order}, so it must be rebuilt!')
+    
+    # merge in the counts from each relevant export, once per unique export
+    for hash in unique:
+        if not any(hash in waiting for waiting in pending.values()):
+            continue
+        with open(f'{PARTIALS}{hash}-{order}.jason', encoding='utf8') as file:
+            counts: dict[str, dict[str, dict[str, int]]] = json.loads(file.read())
+        for author, markov in counts.items():
+            user = users.get(author)
+            if user and hash in pending[user]:
+                merge_markov(chains[user], markov)
+    
+    # each chain is marked as up to date only after it has been saved
+    for user, markov in chains.items():
+        export(markov, user, budget)
+        
+        merged = unique if rebuild else [*manifest.get(user, []), *pending[user]]
+        manifest[user] = list(dict.fromkeys(merged))
+        with open(f'{MANIFEST}.tmp', 'w', encoding='utf8') as file:
+            file.write(json.dumps(manifest))
+        os.replace(f'{MANIFEST}.tmp', MANIFEST)
+    
+    return chains
@@ -0,0 +1,143 @@
+import math
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, Iterator, Sequence, Tuple
+
+# Metrics are recorded from the event loop and worker threads alike, and read
+# by the web server's thread, so every metric guards its values with a lock.
+# They are rendered in the Prometheus text exposition format.
+
+Labels = Tuple[str, ...]
+Sample = Tuple[str, Labels, Labels, float]
+
+class Metric():
+    '''A named measurement, tracked separately for each combination of label values.'''
+    
+    kind: str = 'untyped'
+    name: str
+    description: str
+    labels: Labels
+    _lock: Lock
+    
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        
+        with REGISTRY_LOCK:
+            REGISTRY.append(self)
+    
+    def samples(self) -> Iterator[Sample]:
+        '''Yields the name suffix, label names, label values and value of each sample of this metric.'''
+        
+        return iter(())
+    
+    def render(self) -> str:
+        '''Formats this metric in the Prometheus text format.'''
+        
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for suffix, names, values, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(names, values)} {format_value(value)}')
+        
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    '''A count which only ever goes up.'''
+    
+    kind = 'counter'
+    _values: dict[Labels, float]
+    
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values = {}
+    
+    def inc(self, *values: str, amount: float = 1.0) -> None:
+        '''Increases the count for the specified label values.'''
+        
+        with self._lock:
+            self._values[values] = self._values.get(values, 0.0) + amount
+    
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            items = list(self._values.items())
+        
+        for values, value in items:
+            yield '', self.labels, values, value
+
+class Gauge(Metric):
+    '''A value which is read from a function whenever the metrics are collected.'''
+    
+    kind = 'gauge'
+    _function: Callable[[], float]
+    
+    def __init__(self, name: str, description: str, function: Callable[[], float]):
+        super().__init__(name, description)
+        self._function = function
+    
+    def samples(self) -> Iterator[Sample]:
+        yield '', (), (), self._function()
+
+class Histogram(Metric):
+    '''Counts observations, such as durations in seconds, in cumulative buckets.'''
+    
+    kind = 'histogram'
+    buckets: Tuple[float, ...]
+    _values: dict[Labels, Tuple[list[int], float]]
+    
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (), buckets: Sequence[float] = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+    
+    def observe(self, amount: float, *values: str) -> None:
+        '''Records an observation for the specified label values.'''
+        
+        # observations are only counted in their own bucket, and accumulated when rendered
+        index = bisect_left(self.buckets, amount)
+        with self._lock:
+            counts, total = self._values.get(values) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._values[values] = counts, total + amount
+    
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            items = [(values, list(counts), total) for values, (counts, total) in self._values.items()]
+        
+        # the bucket samples carry an extra label for their upper bound
+        for values, counts, total in items:
+            count = 0
+            for bound, amount in zip((*self.buckets, math.inf), counts):
+                count += amount
+                yield '_bucket', (*self.labels, 'le'), (*values, format_value(bound)), count
+            yield '_sum', self.labels, values, total
+            yield '_count', self.labels, values, count
+
+REGISTRY: list[Metric] = []
+REGISTRY_LOCK = Lock()
+
+def format_value(value: float) -> str:
+    '''Formats a number as Prometheus expects it.'''
+    
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    '''Formats a set of labels as Prometheus expects them, escaping their values.'''
+    
+    if not names:
+        return ''
+    
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+def render() -> str:
+    '''Formats every registered metric in the Prometheus text format.'''
+    
+    with REGISTRY_LOCK:
+        metrics = list(REGISTRY)
+    
+    return ''.join(f'{metric.render()}\n' for metric in metrics)
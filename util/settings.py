@@ -30,6 +30,11 @@ class Settings():
         
         return obj if obj is not None else default
     
+    def replace(self, data: dict[str, Any]) -> None:
+        '''Replaces every setting at once, so that readers see either the old or the new settings.'''
+        
+        self._data = data
+    
     def keys(self) -> list[str]:
         '''Returns list of all keys.'''
         